@@ -0,0 +1,154 @@
+import asyncio
+import heapq
+import itertools
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, Tuple
+
+# Work priorities: lower runs first when the queue is contended
+PRIORITY_TEXT = 0
+PRIORITY_VOICE = 1
+PRIORITY_VOICE_TO_VOICE = 2
+
+
+class Overloaded(Exception):
+    pass
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def take(self) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def retry_after(self) -> float:
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+class RateLimiter:
+    """Per-key token buckets (one per user ID or client IP)."""
+
+    def __init__(self, per_minute: float, burst: int, max_keys: int = 10000):
+        self.rate = per_minute / 60.0
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets: Dict[str, TokenBucket] = {}
+        self.limited = 0
+
+    def allow(self, key: str) -> Tuple[bool, float]:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= self.max_keys:
+                self._prune()
+            bucket = self._buckets[key] = TokenBucket(self.rate, self.burst)
+        if bucket.take():
+            return True, 0.0
+        self.limited += 1
+        return False, bucket.retry_after()
+
+    def _prune(self):
+        # A bucket idle long enough to refill completely is equivalent to a new one
+        refill = self.burst / self.rate
+        now = time.monotonic()
+        self._buckets = {k: b for k, b in self._buckets.items() if now - b.updated < refill}
+
+
+class AdmissionController:
+    """Bounded priority work queue in front of the upstream pipeline."""
+
+    def __init__(self, max_concurrent: int, max_queue: int, queue_timeout: float):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.rejected = 0
+        self.expired = 0
+        self._waiters = []  # heap of (priority, seq, future)
+        self._seq = itertools.count()
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiters)
+
+    def metrics(self) -> Dict[str, int]:
+        return {
+            "active": self.active,
+            "queue_depth": self.queue_depth,
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+            "rejected": self.rejected,
+            "expired": self.expired,
+        }
+
+    @asynccontextmanager
+    async def slot(self, priority: int = PRIORITY_TEXT):
+        await self._acquire(priority)
+        try:
+            yield
+        finally:
+            self._release()
+
+    async def _acquire(self, priority: int):
+        if self.active < self.max_concurrent and not self._waiters:
+            self.active += 1
+            return
+        if len(self._waiters) >= self.max_queue:
+            self.rejected += 1
+            raise Overloaded("queue full")
+
+        future = asyncio.get_event_loop().create_future()
+        entry = (priority, next(self._seq), future)
+        heapq.heappush(self._waiters, entry)
+        try:
+            await asyncio.wait_for(future, self.queue_timeout)
+        except asyncio.TimeoutError:
+            self._remove(entry)
+            self.expired += 1
+            raise Overloaded("queue deadline exceeded")
+        except BaseException:
+            # Caller went away; hand back a slot granted in the meantime
+            if future.done() and not future.cancelled():
+                self._release()
+            else:
+                self._remove(entry)
+            raise
+
+    def _remove(self, entry):
+        if entry in self._waiters:
+            self._waiters.remove(entry)
+            heapq.heapify(self._waiters)
+
+    def _release(self):
+        # Hand the slot straight to the highest-priority waiter, if any
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+
+
+def rate_limiter_from_env() -> RateLimiter:
+    return RateLimiter(
+        per_minute=float(os.getenv('RATE_LIMIT_PER_MINUTE', '20')),
+        burst=int(os.getenv('RATE_LIMIT_BURST', '5')),
+    )
+
+
+def admission_from_env() -> AdmissionController:
+    return AdmissionController(
+        max_concurrent=int(os.getenv('MAX_CONCURRENT_REQUESTS', '8')),
+        max_queue=int(os.getenv('MAX_QUEUED_REQUESTS', '32')),
+        queue_timeout=float(os.getenv('QUEUE_TIMEOUT_SECONDS', '10')),
+    )
@@ -1,26 +1,73 @@
-from fastapi import FastAPI, HTTPException, UploadFile, File
+from fastapi import FastAPI, HTTPException, UploadFile, File, Request, Depends, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import Response
+from fastapi.responses import Response, JSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
+from starlette.requests import HTTPConnection
 from pydantic import BaseModel
 import openai
-from pinecone import Pinecone
 import os
 import tempfile
 from dotenv import load_dotenv
 import logging
 import asyncio
+import functools
+import hmac
+import json
+import re
+import threading
 from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 import jwt
 import time
+from logging.handlers import WatchedFileHandler
+from typing import AsyncIterator, Dict, List
+from chunk_store import open_default_store
+from lexical_index import LexicalIndex, is_exact_hit, reciprocal_rank_fusion
+from single_flight import SingleFlight, coalesce_key
+from query_cache import LRUCache, load_snapshot, save_snapshot
+from tracing import admin_router, annotate, install_log_context, stage, tracer_from_env
+from resilience import CircuitOpen, Deadline, Upstream, retry_with_backoff
+from batch_query import parse_jsonl
+from chat_manager import ChatManager, SessionCache, compaction_loop
+from admission import (
+    Overloaded, PRIORITY_TEXT, PRIORITY_VOICE, PRIORITY_VOICE_TO_VOICE,
+    admission_from_env, rate_limiter_from_env,
+)
 
 # Load environment variables
 load_dotenv()
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
+install_log_context()
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Alrah AI API", description="Arabic Religious Library Query API")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Serve /health and /ready immediately; finish initialization in the background
+    warmup_task = asyncio.create_task(ai.warmup())
+    compaction_task = asyncio.create_task(compaction_loop(sessions.chat_manager))
+    store_task = asyncio.create_task(ai.watch_chunk_store())
+    if telegram_webhook:
+        await telegram_webhook.start()
+    yield
+    if telegram_webhook:
+        await telegram_webhook.stop()
+    warmup_task.cancel()
+    compaction_task.cancel()
+    store_task.cancel()
+    # Keep this worker's caches so the next start does not begin cold
+    await asyncio.get_event_loop().run_in_executor(ai.executor, ai.save_cache_snapshot)
+    ai.executor.shutdown(wait=False)
+
+app = FastAPI(title="Alrah AI API", description="Arabic Religious Library Query API", lifespan=lifespan)
+
+# Optionally receive Telegram bot updates on this server too (see telegram_webhook.py)
+telegram_webhook = None
+if os.getenv('TELEGRAM_WEBHOOK_IN_API') == '1':
+    from telegram_webhook import TelegramWebhook
+    telegram_webhook = TelegramWebhook()
+    app.include_router(telegram_webhook.router)
 
 # Add CORS middleware
 app.add_middleware(
@@ -53,66 +100,445 @@ class QueryResponse(BaseModel):
     transcription: str = None
 
 class AlrahAI:
+    # Shorter system prompt for faster processing
+    SYSTEM_PROMPT = """أنت مساعد ذكي متخصص في مكتبة الرحيق المختوم للشيخ محمد اليعقوبي. أجب باللغة العربية الفصحى بأسلوب علمي مختصر ومفيد."""
+    
     def __init__(self):
+        # Only cheap, local setup here; network-bound setup happens in warmup()
         self.openai_client = openai.OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
-        pc = Pinecone(api_key=os.getenv('PINECONE_API_KEY'))
-        self.index = pc.Index(os.getenv('PINECONE_INDEX_NAME'))
-        self.executor = ThreadPoolExecutor(max_workers=4)
+        self.index = None
+        self.executor = ThreadPoolExecutor(max_workers=16)  # Headroom for hedged and abandoned calls
+        self.chunk_store = open_default_store()
+        self.lexical_index = LexicalIndex()
+        self.lexical_generation = 0
+        self.inflight = SingleFlight()
+        self.started_at = time.monotonic()
+        self.warmup_state = {
+            "cache": "pending", "pinecone": "pending", "connections": "pending", "lexical_index": "pending"
+        }
+        
+        # Per-request latency budget; upstream calls get timeouts, hedging and circuit breakers
+        self.budget = float(os.getenv('REQUEST_BUDGET_SECONDS', '12'))
+        self.upstream_client = self.openai_client.with_options(timeout=self.budget, max_retries=0)
+        self.embeddings = Upstream("openai-embeddings", self.executor, hedge=True, default_latency=0.5)
+        self.pinecone = Upstream("pinecone", self.executor, hedge=True, default_latency=0.5)
+        self.chat = Upstream("openai-chat", self.executor, default_latency=4.0)
         
-    async def search_and_respond(self, query_text: str) -> str:
-        # Run embedding and search in parallel
-        embedding_task = asyncio.create_task(self._get_embedding(query_text))
+        # Repeated questions skip upstream calls; snapshots from query_cache.py prewarm these at startup
+        cache_size = int(os.getenv('QUERY_CACHE_SIZE', '5000'))
+        cache_ttl = float(os.getenv('QUERY_CACHE_TTL_SECONDS', '86400'))
+        self.answer_cache = LRUCache(cache_size, cache_ttl)
+        self.context_cache = LRUCache(cache_size, cache_ttl)
+        self.embedding_cache = LRUCache(cache_size, cache_ttl)
+        self.cache_snapshot_path = os.getenv('QUERY_CACHE_SNAPSHOT', 'cache/query_cache.json.gz')
+        self.query_log = _query_logger(os.getenv('QUERY_LOG_PATH', 'logs/queries.jsonl'))
         
-        embedding = await embedding_task
+    @property
+    def ready(self) -> bool:
+        return self.index is not None
+    
+    def _connect_pinecone(self):
+        from pinecone import Pinecone  # Deferred: the client is slow to import
+        return Pinecone(api_key=os.getenv('PINECONE_API_KEY')).Index(os.getenv('PINECONE_INDEX_NAME'))
+    
+    async def warmup(self):
+        loop = asyncio.get_event_loop()
+        
+        try:
+            loaded = await loop.run_in_executor(self.executor, self.load_cache_snapshot)
+            self.warmup_state["cache"] = f"loaded {loaded} entries"
+        except Exception as e:
+            logger.warning(f"Could not load cache snapshot: {e}")
+            self.warmup_state["cache"] = f"failed: {e}"
         
-        # Query Pinecone
-        results = await asyncio.get_event_loop().run_in_executor(
-            self.executor, self._query_pinecone, embedding
+        # A Pinecone hiccup is retried here instead of crashing the service into a restart loop
+        def on_retry(e):
+            self.warmup_state["pinecone"] = f"retrying: {e}"
+        self.index = await retry_with_backoff(
+            self._connect_pinecone, "Connecting to Pinecone", self.executor, on_retry=on_retry
         )
+        self.warmup_state["pinecone"] = "done"
+        logger.info(f"Ready after {time.monotonic() - self.started_at:.2f}s")
+        
+        # Open upstream connection pools before the first real request needs them
+        try:
+            await asyncio.gather(
+                loop.run_in_executor(self.executor, self.index.describe_index_stats),
+                loop.run_in_executor(self.executor, self.upstream_client.models.list),
+            )
+            self.warmup_state["connections"] = "done"
+        except Exception as e:
+            logger.warning(f"Connection warmup failed: {e}")
+            self.warmup_state["connections"] = f"failed: {e}"
+        
+        self.warmup_state["lexical_index"] = "building"
+        self.lexical_generation = self.chunk_store.generation
+        await loop.run_in_executor(self.executor, self.lexical_index.build, self.chunk_store.items())
+        self.warmup_state["lexical_index"] = "done"
+    
+    async def watch_chunk_store(self, interval: float = 30.0):
+        """Pick up `chunk_store.py sync` runs without a restart and rebuild the lexical index from them."""
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await loop.run_in_executor(self.executor, self.chunk_store.refresh)
+                if self.warmup_state["lexical_index"] != "done" or self.lexical_generation == self.chunk_store.generation:
+                    continue
+                self.lexical_generation = self.chunk_store.generation
+                # Built aside and swapped in whole, so searches never see a half-built index
+                lexical_index = LexicalIndex()
+                await loop.run_in_executor(self.executor, lexical_index.build, self.chunk_store.items())
+                self.lexical_index = lexical_index
+                logger.info(f"Rebuilt lexical index after chunk store reload ({len(lexical_index)} chunks)")
+            except Exception as e:
+                logger.warning(f"Chunk store refresh failed: {e}")
+    
+    def load_cache_snapshot(self) -> int:
+        entries = load_snapshot(self.cache_snapshot_path)
+        now = time.time()
+        loaded = 0
+        for entry in entries:
+            if entry["expires_at"] < now:
+                continue
+            loaded += 1
+            for name, cache in (("answer", self.answer_cache), ("context", self.context_cache),
+                                ("embedding", self.embedding_cache)):
+                if entry.get(name) is not None:
+                    cache.set(entry["key"], entry[name], entry["expires_at"])
+        return loaded
+    
+    def save_cache_snapshot(self):
+        entries = {}
+        for name, cache in (("answer", self.answer_cache), ("context", self.context_cache),
+                            ("embedding", self.embedding_cache)):
+            for key, expires_at, value in cache.items():
+                entry = entries.setdefault(key, {"key": key, "expires_at": expires_at})
+                entry[name] = value
+                entry["expires_at"] = min(entry["expires_at"], expires_at)
+        for entry in entries.values():
+            # Embeddings are large and only needed when the context is not cached
+            if "context" in entry:
+                entry.pop("embedding", None)
+        save_snapshot(self.cache_snapshot_path, list(entries.values()), limit=self.answer_cache.max_items)
+    
+    async def search_and_respond(self, query_text: str, log_query: bool = True) -> str:
+        key = coalesce_key(query_text)
+        if log_query and self.query_log:
+            self.query_log.info(json.dumps({"t": int(time.time()), "q": query_text}, ensure_ascii=False))
+        cached = self.answer_cache.get(key)
+        annotate(answer_cache="hit" if cached is not None else "miss")
+        if cached is not None:
+            return cached
+        # Identical questions already in flight share one upstream execution
+        with stage("answer"):
+            return await self.inflight.do(key, lambda: self._search_and_respond(query_text))
+    
+    async def _search_and_respond(self, query_text: str) -> str:
+        deadline = Deadline(self.budget)
+        context_texts = await self._retrieve_context(query_text, deadline)
+        
+        context_text = self._build_context_text(context_texts)
+        
+        # Fall back to an extractive answer when generation would blow the budget
+        if deadline.remaining() < self.chat.latency.percentile(0.5):
+            logger.warning(f"Skipping generation with {deadline.remaining():.2f}s left in budget")
+            return self._extractive_answer(context_texts)
+        try:
+            with stage("generation"):
+                response = await self.chat.call(
+                    self._generate_response, self.SYSTEM_PROMPT, context_text, query_text,
+                    timeout=deadline.remaining()
+                )
+        except Exception as e:
+            logger.warning(f"Generation unavailable ({e!r}), returning extractive answer")
+            return self._extractive_answer(context_texts)
+        
+        # Only generated answers are cached; extractive fallbacks should be retried next time
+        answer = response.choices[0].message.content
+        self.answer_cache.set(coalesce_key(query_text), answer)
+        return answer
+    
+    async def stream_answer(self, query_text: str, history: List[Dict] = None) -> AsyncIterator[str]:
+        if history:
+            async for token in self._stream_answer(query_text, history):
+                yield token
+            return
+        key = coalesce_key(query_text)
+        cached = self.answer_cache.get(key)
+        annotate(answer_cache="hit" if cached is not None else "miss")
+        if cached is not None:
+            yield cached
+            return
+        # Opening questions do not depend on history, so identical ones share one generation
+        async for token in self.inflight.stream(key, lambda: self._stream_answer(query_text, None)):
+            yield token
+    
+    async def _stream_answer(self, query_text: str, history: List[Dict] = None) -> AsyncIterator[str]:
+        deadline = Deadline(self.budget)
+        context_texts = await self._retrieve_context(query_text, deadline)
+        
+        history_context = ""
+        if history:
+            history_context = "\n\nسياق المحادثة السابقة:\n"
+            for msg in history[-5:]:  # Last 5 messages
+                role = "المستخدم" if msg["role"] == "user" else "المساعد"
+                history_context += f"{role}: {msg['content'][:100]}...\n"
+        messages = [
+            {"role": "system", "content": self.SYSTEM_PROMPT},
+            {"role": "user", "content": f"السياق: {self._build_context_text(context_texts)}{history_context}\n\nالسؤال: {query_text}"}
+        ]
         
-        # Build context (reduced size for faster processing)
-        context_texts = []
-        for match in results.matches[:5]:  # Reduced from 10 to 5
-            if match.score > 0.3:
-                context_texts.append(match.metadata.get('text', ''))
+        produced = []
+        try:
+            with stage("generation"):
+                async for token in self._stream_completion(messages, deadline):
+                    produced.append(token)
+                    yield token
+        except Exception as e:
+            # Once tokens have gone out a fallback would garble the answer
+            if produced:
+                raise
+            logger.warning(f"Streaming generation unavailable ({e!r}), returning extractive answer")
+            yield self._extractive_answer(context_texts)
+            return
+        if not history:
+            self.answer_cache.set(coalesce_key(query_text), "".join(produced))
+    
+    async def _stream_completion(self, messages: List[Dict], deadline: Deadline) -> AsyncIterator[str]:
+        if not self.chat.breaker.allow():
+            raise CircuitOpen(self.chat.name)
+        loop = asyncio.get_event_loop()
+        queue = asyncio.Queue()
+        stop = threading.Event()
+        finished = object()
+        
+        # The SDK stream is blocking; a worker thread feeds tokens back into the event loop
+        def worker():
+            try:
+                stream = self.upstream_client.chat.completions.create(
+                    model="gpt-4o-mini",
+                    messages=messages,
+                    max_tokens=300,
+                    temperature=0.7,
+                    stream=True
+                )
+                for chunk in stream:
+                    if stop.is_set():
+                        stream.close()
+                        break
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        loop.call_soon_threadsafe(queue.put_nowait, chunk.choices[0].delta.content)
+                loop.call_soon_threadsafe(queue.put_nowait, finished)
+            except Exception as e:
+                loop.call_soon_threadsafe(queue.put_nowait, e)
+        
+        loop.run_in_executor(self.executor, worker)
+        started = time.monotonic()
+        produced = False
+        try:
+            while True:
+                # The first token must arrive within the request budget, later ones within a stall window
+                timeout = deadline.remaining() if not produced else max(deadline.remaining(), self.budget * 0.25)
+                try:
+                    item = await asyncio.wait_for(queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    self.chat.timeouts += 1
+                    self.chat.breaker.record_failure()
+                    raise asyncio.TimeoutError(f"{self.chat.name} stream stalled after {time.monotonic() - started:.2f}s")
+                if item is finished:
+                    self.chat.latency.record(time.monotonic() - started)
+                    self.chat.breaker.record_success()
+                    return
+                if isinstance(item, Exception):
+                    self.chat.breaker.record_failure()
+                    raise item
+                produced = True
+                yield item
+        finally:
+            stop.set()
+            # A client that disconnects mid-stream leaves no outcome; do not hold a half-open probe
+            self.chat.breaker.release()
+    
+    async def batch_answer(self, items: List[Dict], concurrency: int = 32) -> AsyncIterator[Dict]:
+        """Answer many questions with bulk embeddings and bounded parallelism, yielding results as they finish."""
+        loop = asyncio.get_event_loop()
+        # A dedicated pool keeps bulk runs from starving interactive requests of threads
+        executor = ThreadPoolExecutor(max_workers=concurrency)
+        # Embedded items waiting for a worker; bounds how many vectors are held at once
+        embedded = asyncio.Queue(maxsize=2 * concurrency)
+        finished = asyncio.Queue()
+        
+        def new_record(position, item):
+            return {"index": position, "id": item.get("id"), "text": item["text"]}
         
-        if not context_texts:
-            context_texts = [match.metadata.get('text', '') for match in results.matches[:2]]  # Reduced from 3 to 2
+        async def answer(position, item, embedding, embed_seconds):
+            record = new_record(position, item)
+            timings = {"embedding": round(embed_seconds, 3)}
+            started = time.monotonic()
+            try:
+                lexical_hits = await loop.run_in_executor(executor, self.lexical_index.search, item["text"], 10)
+                stage_start = time.monotonic()
+                results = await loop.run_in_executor(executor, self._query_pinecone, embedding)
+                timings["retrieval"] = round(time.monotonic() - stage_start, 3)
+                context_text = self._build_context_text(self._fuse_results(results, lexical_hits))
+                stage_start = time.monotonic()
+                response = await loop.run_in_executor(executor, functools.partial(
+                    self._generate_response, self.SYSTEM_PROMPT, context_text, item["text"],
+                    client=self.openai_client  # Default retries suit bulk runs better than the hedged path
+                ))
+                timings["generation"] = round(time.monotonic() - stage_start, 3)
+                record["response"] = response.choices[0].message.content
+            except Exception as e:
+                record["error"] = str(e)
+            timings["total"] = round(embed_seconds + time.monotonic() - started, 3)
+            record["timings"] = timings
+            await finished.put(record)
         
+        async def produce():
+            for start in range(0, len(items), 256):
+                batch = items[start:start + 256]
+                stage_start = time.monotonic()
+                try:
+                    embeddings = await loop.run_in_executor(
+                        executor, self._create_embeddings, [item["text"] for item in batch]
+                    )
+                except Exception as e:
+                    share = round((time.monotonic() - stage_start) / len(batch), 3)
+                    for offset, item in enumerate(batch):
+                        await finished.put({
+                            **new_record(start + offset, item), "error": f"embedding failed: {e}",
+                            "timings": {"embedding": share, "total": share},
+                        })
+                    continue
+                # One bulk call serves the whole batch, so each item is charged its share
+                embed_seconds = (time.monotonic() - stage_start) / len(batch)
+                for offset, (item, embedding) in enumerate(zip(batch, embeddings)):
+                    # Waits while workers are behind, so the next batch is embedded only when needed
+                    await embedded.put((start + offset, item, embedding, embed_seconds))
+            for _ in range(concurrency):
+                await embedded.put(None)
+        
+        async def work():
+            while True:
+                job = await embedded.get()
+                if job is None:
+                    return
+                await answer(*job)
+        
+        tasks = [asyncio.create_task(produce())] + [asyncio.create_task(work()) for _ in range(concurrency)]
+        
+        async def run():
+            try:
+                await asyncio.gather(*tasks)
+            finally:
+                await finished.put(None)
+        
+        runner = asyncio.create_task(run())
+        try:
+            while True:
+                record = await finished.get()
+                if record is None:
+                    break
+                yield record
+            await runner  # Surfaces a producer or worker failure
+        finally:
+            # Stops outstanding work if the consumer goes away early
+            for task in tasks + [runner]:
+                task.cancel()
+            executor.shutdown(wait=False)
+    
+    @staticmethod
+    def _build_context_text(context_texts: List[str]) -> str:
         context_text = "\n".join(context_texts) if context_texts else "لا توجد معلومات متاحة في قاعدة البيانات"
         if len(context_text) > 2000:  # Reduced from 4000 to 2000
             context_text = context_text[:2000] + "..."
+        return context_text
+    
+    @staticmethod
+    def _extractive_answer(context_texts: List[str]) -> str:
+        context_text = "\n".join(t for t in context_texts[:3] if t) or "لا توجد معلومات متاحة"
+        if len(context_text) > 1000:
+            context_text = context_text[:1000] + "..."
+        return f"بناءً على مكتبة الرحيق المختوم: {context_text}"
+    
+    async def _retrieve_context(self, query_text: str, deadline: Deadline) -> List[str]:
+        key = coalesce_key(query_text)
+        cached = self.context_cache.get(key)
+        annotate(context_cache="hit" if cached is not None else "miss")
+        if cached is not None:
+            return cached
+        loop = asyncio.get_event_loop()
+        with stage("lexical"):
+            lexical_hits = await loop.run_in_executor(
+                self.executor, self.lexical_index.search, query_text, 10
+            )
         
-        # Generate response with shorter system prompt
-        system_prompt = """أنت مساعد ذكي متخصص في مكتبة الرحيق المختوم للشيخ محمد اليعقوبي. أجب باللغة العربية الفصحى بأسلوب علمي مختصر ومفيد."""
+        # Exact-phrase hits (verses, book titles, hadith wording) skip the embedding round-trip
+        if lexical_hits and is_exact_hit(query_text, self.chunk_store.get(lexical_hits[0][0], '')):
+            return [self.chunk_store.get(chunk_id, '') for chunk_id, _ in lexical_hits[:3]]
         
-        response = await asyncio.get_event_loop().run_in_executor(
-            self.executor, self._generate_response, system_prompt, context_text, query_text
-        )
+        try:
+            embedding = self.embedding_cache.get(key)
+            if embedding is None:
+                with stage("embedding"):
+                    embedding = await self.embeddings.call(
+                        self._create_embedding, query_text, timeout=deadline.stage(0.25)
+                    )
+                self.embedding_cache.set(key, embedding)
+            
+            # Query Pinecone
+            with stage("pinecone"):
+                results = await self.pinecone.call(
+                    self._query_pinecone, embedding, timeout=deadline.stage(0.25)
+                )
+        except Exception as e:
+            # Lexical hits are still a usable context when vector search is down or slow
+            if not lexical_hits:
+                raise
+            logger.warning(f"Vector search unavailable ({e!r}), using lexical hits only")
+            return [self.chunk_store.get(chunk_id, '') for chunk_id, _ in lexical_hits[:4]]
         
-        return response.choices[0].message.content
+        context_texts = self._fuse_results(results, lexical_hits)
+        self.context_cache.set(key, context_texts)
+        return context_texts
     
-    async def _get_embedding(self, text: str):
-        return await asyncio.get_event_loop().run_in_executor(
-            self.executor, self._create_embedding, text
-        )
+    def _fuse_results(self, results, lexical_hits) -> List[str]:
+        texts = {}
+        vector_ranking = [match.id for match in results.matches if match.score > 0.3]
+        if not vector_ranking:
+            vector_ranking = [match.id for match in results.matches[:2]]
+        for match in results.matches:
+            texts[match.id] = self.chunk_store.match_text(match)
+        
+        # Fuse vector and lexical rankings so fewer, better chunks reach the LLM
+        fused = reciprocal_rank_fusion(vector_ranking, [chunk_id for chunk_id, _ in lexical_hits])
+        return [texts.get(chunk_id) or self.chunk_store.get(chunk_id, '') for chunk_id, _ in fused[:4]]
     
     def _create_embedding(self, text: str):
-        return self.openai_client.embeddings.create(
+        return self.upstream_client.embeddings.create(
             model="text-embedding-3-small",
             input=text
         ).data[0].embedding
     
+    def _create_embeddings(self, texts: List[str]):
+        response = self.openai_client.embeddings.create(
+            model="text-embedding-3-small",
+            input=texts
+        )
+        return [item.embedding for item in sorted(response.data, key=lambda d: d.index)]
+    
     def _query_pinecone(self, embedding):
-        return self.index.query(
+        results = self.index.query(
             vector=embedding,
             top_k=5,  # Reduced from 10 to 5
-            include_metadata=True,
+            include_metadata=not len(self.chunk_store),  # Text is resolved locally when synced
             include_values=False
         )
+        return self.chunk_store.resolve_missing(self.index, results)
     
-    def _generate_response(self, system_prompt, context_text, query_text):
-        return self.openai_client.chat.completions.create(
+    def _generate_response(self, system_prompt, context_text, query_text, client=None):
+        return (client or self.upstream_client).chat.completions.create(
             model="gpt-4o-mini",
             messages=[
                 {"role": "system", "content": system_prompt},
@@ -130,10 +556,90 @@ class AlrahAI:
                 language="ar"
             )
 
+def _query_logger(path: str):
+    """JSONL log of incoming questions, mined by query_cache.py for prewarming."""
+    if not path:
+        return None
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    query_log = logging.getLogger("alrah.queries")
+    query_log.propagate = False
+    if not query_log.handlers:
+        # Rotated externally (logrotate); each worker reopens the file once it has been moved
+        handler = WatchedFileHandler(path, encoding='utf-8')
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        query_log.addHandler(handler)
+        query_log.setLevel(logging.INFO)
+    return query_log
+
 # Initialize AI instance
 ai = AlrahAI()
 
-@app.post("/query/text", response_model=QueryResponse)
+# Per-client rate limiting and bounded priority queue in front of the pipeline
+rate_limiter = rate_limiter_from_env()
+admission = admission_from_env()
+
+# Per-request stage traces; slow ones are logged with their full breakdown
+tracer = tracer_from_env()
+app.include_router(admin_router(tracer))
+
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    with tracer.request(
+        f"{request.method} {request.url.path}", request.headers.get("X-Request-Id")
+    ) as trace:
+        response = await call_next(request)
+        trace.attrs["status"] = response.status_code
+    response.headers["X-Request-Id"] = trace.trace_id
+    return response
+
+# Only these peers (e.g. the reverse proxy) may vouch for the real client via headers
+TRUSTED_PROXIES = {ip.strip() for ip in os.getenv('TRUSTED_PROXIES', '').split(',') if ip.strip()}
+
+def _client_key(connection: HTTPConnection) -> str:
+    peer = connection.client.host if connection.client else 'unknown'
+    if peer not in TRUSTED_PROXIES:
+        # Headers from untrusted peers are client-controlled and would let anyone pick a fresh bucket
+        return f"ip:{peer}"
+    user_id = connection.headers.get("X-User-Id")
+    if user_id:
+        return f"user:{user_id}"
+    # The rightmost address not added by one of our proxies is the client
+    for address in reversed(connection.headers.get("X-Forwarded-For", "").split(',')):
+        address = address.strip()
+        if address and address not in TRUSTED_PROXIES:
+            return f"ip:{address}"
+    return f"ip:{peer}"
+
+def admit(priority: int):
+    async def dependency(request: Request):
+        if not ai.ready:
+            raise HTTPException(
+                status_code=503,
+                detail="جار تهيئة الخدمة، يرجى المحاولة بعد قليل",
+                headers={"Retry-After": "5"}
+            )
+        allowed, retry_after = rate_limiter.allow(_client_key(request))
+        if not allowed:
+            raise HTTPException(
+                status_code=429,
+                detail="تم تجاوز عدد الطلبات المسموح به، يرجى المحاولة لاحقاً",
+                headers={"Retry-After": str(int(retry_after) + 1)}
+            )
+        queued = time.monotonic()
+        try:
+            async with admission.slot(priority):
+                annotate(queue_wait=round(time.monotonic() - queued, 4))
+                yield
+        except Overloaded as e:
+            logger.warning(f"Shedding request ({e}), queue depth {admission.queue_depth}")
+            raise HTTPException(
+                status_code=503,
+                detail="الخادم مشغول حالياً، يرجى المحاولة بعد قليل",
+                headers={"Retry-After": "5"}
+            )
+    return Depends(dependency)
+
+@app.post("/query/text", response_model=QueryResponse, dependencies=[admit(PRIORITY_TEXT)])
 async def query_text(query: TextQuery):
     try:
         response = await ai.search_and_respond(query.text)
@@ -142,7 +648,7 @@ async def query_text(query: TextQuery):
         logger.error(f"Error processing text query: {e}")
         raise HTTPException(status_code=500, detail="خطأ في معالجة الاستعلام")
 
-@app.post("/query/voice", response_model=QueryResponse)
+@app.post("/query/voice", response_model=QueryResponse, dependencies=[admit(PRIORITY_VOICE)])
 async def query_voice(file: UploadFile = File(...)):
     try:
         # Save uploaded file temporarily
@@ -152,9 +658,10 @@ async def query_voice(file: UploadFile = File(...)):
             temp_file.flush()
             
             # Transcribe audio in executor
-            transcript = await asyncio.get_event_loop().run_in_executor(
-                ai.executor, ai._transcribe_audio, temp_file.name
-            )
+            with stage("transcription"):
+                transcript = await asyncio.get_event_loop().run_in_executor(
+                    ai.executor, ai._transcribe_audio, temp_file.name
+                )
             
             # Get response
             response = await ai.search_and_respond(transcript.text)
@@ -168,6 +675,53 @@ async def query_voice(file: UploadFile = File(...)):
         logger.error(f"Error processing voice query: {e}")
         raise HTTPException(status_code=500, detail="خطأ في معالجة الرسالة الصوتية")
 
+# Bulk evaluation runs hold a batch slot for their whole duration
+batch_slots = asyncio.Semaphore(int(os.getenv('MAX_CONCURRENT_BATCHES', '1')))
+MAX_BATCH_ITEMS = int(os.getenv('MAX_BATCH_ITEMS', '20000'))
+
+@app.post("/query/batch")
+async def query_batch(request: Request, concurrency: int = 32):
+    if not ai.ready:
+        raise HTTPException(status_code=503, detail="جار تهيئة الخدمة، يرجى المحاولة بعد قليل")
+    # Bulk runs can cost thousands of upstream calls, so they need the admin token
+    token = os.getenv('ADMIN_TOKEN')
+    if not token or not hmac.compare_digest(request.headers.get("X-Admin-Token", ""), token):
+        raise HTTPException(status_code=403, detail="Forbidden")
+    allowed, retry_after = rate_limiter.allow(_client_key(request))
+    if not allowed:
+        raise HTTPException(
+            status_code=429,
+            detail="تم تجاوز عدد الطلبات المسموح به، يرجى المحاولة لاحقاً",
+            headers={"Retry-After": str(int(retry_after) + 1)}
+        )
+    try:
+        items = parse_jsonl((await request.body()).decode('utf-8'))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if len(items) > MAX_BATCH_ITEMS:
+        raise HTTPException(status_code=413, detail=f"Batch exceeds {MAX_BATCH_ITEMS} questions")
+    if batch_slots.locked():
+        raise HTTPException(status_code=503, detail="A batch run is already in progress", headers={"Retry-After": "60"})
+    # Taken before responding (no await since the check), so a concurrent request gets 503 instead of waiting
+    await batch_slots.acquire()
+    released = False
+    
+    def release():
+        nonlocal released
+        if not released:
+            released = True
+            batch_slots.release()
+    
+    async def stream():
+        try:
+            async for record in ai.batch_answer(items, concurrency=max(1, min(concurrency, 64))):
+                yield json.dumps(record, ensure_ascii=False) + "\n"
+        finally:
+            release()
+    
+    # The background task also frees the slot if the client leaves before the stream starts
+    return StreamingResponse(stream(), media_type="application/x-ndjson", background=BackgroundTask(release))
+
 @app.options("/{path:path}")
 async def options_handler(path: str):
     return Response(
@@ -183,15 +737,30 @@ async def options_handler(path: str):
 async def root():
     return {"message": "Alrah AI API is running"}
 
-@app.post("/tts")
+@app.get("/health")
+async def health():
+    return {"status": "ok", "uptime": round(time.monotonic() - ai.started_at, 1)}
+
+@app.get("/ready")
+async def ready():
+    body = {
+        "ready": ai.ready,
+        "warmup": ai.warmup_state,
+        "chunks": len(ai.chunk_store),
+        "lexical_index": len(ai.lexical_index),
+    }
+    return JSONResponse(content=body, status_code=200 if ai.ready else 503)
+
+@app.post("/tts", dependencies=[admit(PRIORITY_VOICE)])
 async def text_to_speech(request: TTSRequest):
     try:
         # Convert text directly to speech without processing as question
-        speech_response = ai.openai_client.audio.speech.create(
-            model="tts-1",
-            voice="alloy",
-            input=request.text
-        )
+        with stage("tts"):
+            speech_response = ai.openai_client.audio.speech.create(
+                model="tts-1",
+                voice="alloy",
+                input=request.text
+            )
         
         # Return audio as response
         audio_content = speech_response.content
@@ -205,17 +774,18 @@ async def text_to_speech(request: TTSRequest):
         logger.error(f"Error in TTS: {e}")
         raise HTTPException(status_code=500, detail="خطأ في تحويل النص إلى صوت")
 
-@app.post("/query/text/audio")
+@app.post("/query/text/audio", dependencies=[admit(PRIORITY_VOICE)])
 async def query_text_audio(query: TextQuery):
     try:
-        response_text = ai.search_and_respond(query.text)
+        response_text = await ai.search_and_respond(query.text)
         
         # Convert response to speech
-        speech_response = ai.openai_client.audio.speech.create(
-            model="tts-1",
-            voice="alloy",
-            input=response_text
-        )
+        with stage("tts"):
+            speech_response = ai.openai_client.audio.speech.create(
+                model="tts-1",
+                voice="alloy",
+                input=response_text
+            )
         
         # Return audio as response
         audio_content = speech_response.content
@@ -229,7 +799,7 @@ async def query_text_audio(query: TextQuery):
         logger.error(f"Error processing text to audio: {e}")
         raise HTTPException(status_code=500, detail="خطأ في معالجة الاستعلام الصوتي")
 
-@app.post("/query/voice/audio")
+@app.post("/query/voice/audio", dependencies=[admit(PRIORITY_VOICE_TO_VOICE)])
 async def query_voice_audio(file: UploadFile = File(...)):
     try:
         # Save uploaded file temporarily
@@ -239,22 +809,24 @@ async def query_voice_audio(file: UploadFile = File(...)):
             temp_file.flush()
             
             # Transcribe audio
-            with open(temp_file.name, 'rb') as audio_file:
-                transcript = ai.openai_client.audio.transcriptions.create(
-                    model="whisper-1",
-                    file=audio_file,
-                    language="ar"
-                )
+            with stage("transcription"):
+                with open(temp_file.name, 'rb') as audio_file:
+                    transcript = ai.openai_client.audio.transcriptions.create(
+                        model="whisper-1",
+                        file=audio_file,
+                        language="ar"
+                    )
             
             # Get response
-            response_text = ai.search_and_respond(transcript.text)
+            response_text = await ai.search_and_respond(transcript.text)
             
             # Convert response to speech
-            speech_response = ai.openai_client.audio.speech.create(
-                model="tts-1",
-                voice="alloy",
-                input=response_text
-            )
+            with stage("tts"):
+                speech_response = ai.openai_client.audio.speech.create(
+                    model="tts-1",
+                    voice="alloy",
+                    input=response_text
+                )
             
             # Cleanup
             os.unlink(temp_file.name)
@@ -310,6 +882,104 @@ async def generate_livekit_token(request: LiveKitTokenRequest):
         logger.error(f"Error generating LiveKit token: {e}")
         raise HTTPException(status_code=500, detail="خطأ في إنشاء رمز الاتصال")
 
+# Web conversations keep their history server-side, next to the Telegram sessions
+sessions = SessionCache(ChatManager())
+_SAFE_ID = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+@app.websocket("/ws/chat")
+async def chat_socket(websocket: WebSocket, user_id: str, session_id: str = None, audio: bool = False):
+    # IDs end up in file names, so only accept plain identifiers
+    if not _SAFE_ID.match(user_id) or (session_id and not _SAFE_ID.match(session_id)):
+        await websocket.close(code=1008)
+        return
+    await websocket.accept()
+    
+    owner = f"web-{user_id}"
+    if not session_id or not sessions.has_session(owner, session_id):
+        session_id = sessions.create_session(owner)
+    await websocket.send_json({"type": "session", "session_id": session_id})
+    
+    try:
+        while True:
+            try:
+                data = await websocket.receive_json()
+            except ValueError:
+                data = None
+            if not isinstance(data, dict):
+                await websocket.send_json({"type": "error", "detail": "Invalid message format"})
+                continue
+            if data.get("type") == "new_session":
+                session_id = sessions.create_session(owner)
+                await websocket.send_json({"type": "session", "session_id": session_id})
+                continue
+            
+            text = (data.get("text") or "").strip()
+            if not text:
+                await websocket.send_json({"type": "error", "detail": "الرسالة فارغة"})
+                continue
+            if not ai.ready:
+                await websocket.send_json({"type": "error", "detail": "جار تهيئة الخدمة، يرجى المحاولة بعد قليل"})
+                continue
+            allowed, _ = rate_limiter.allow(_client_key(websocket))
+            if not allowed:
+                await websocket.send_json({"type": "error", "detail": "تم تجاوز عدد الطلبات المسموح به، يرجى المحاولة لاحقاً"})
+                continue
+            
+            try:
+                with tracer.request("ws /ws/chat", user=owner, session=session_id) as trace:
+                    queued = time.monotonic()
+                    async with admission.slot(PRIORITY_VOICE if audio else PRIORITY_TEXT):
+                        annotate(queue_wait=round(time.monotonic() - queued, 4))
+                        with stage("chat_history"):
+                            history = sessions.get_session_history(owner, session_id)
+                            sessions.add_message(owner, session_id, "user", text)
+                        
+                        parts = []
+                        with stage("answer"):
+                            async for token in ai.stream_answer(text, history):
+                                parts.append(token)
+                                await websocket.send_json({"type": "token", "text": token})
+                        response_text = "".join(parts)
+                        with stage("chat_history"):
+                            sessions.add_message(owner, session_id, "assistant", response_text)
+                        await websocket.send_json({"type": "done", "response": response_text, "request_id": trace.trace_id})
+                        
+                        if audio:
+                            with stage("tts"):
+                                speech_response = await asyncio.get_event_loop().run_in_executor(
+                                    ai.executor, functools.partial(
+                                        ai.openai_client.audio.speech.create, model="tts-1", voice="alloy", input=response_text
+                                    )
+                                )
+                            await websocket.send_json({"type": "audio", "format": "mp3"})
+                            await websocket.send_bytes(speech_response.content)
+            except Overloaded:
+                await websocket.send_json({"type": "error", "detail": "الخادم مشغول حالياً، يرجى المحاولة بعد قليل"})
+            except WebSocketDisconnect:
+                raise
+            except Exception as e:
+                logger.error(f"Error processing chat message: {e}")
+                await websocket.send_json({"type": "error", "detail": "خطأ في معالجة الاستعلام"})
+    except WebSocketDisconnect:
+        pass
+
+@app.get("/metrics")
+async def metrics():
+    return {
+        "admission": admission.metrics(),
+        "rate_limited": rate_limiter.limited,
+        "coalesced": ai.inflight.coalesced,
+        "slow_requests": tracer.slow,
+        "chunk_store_misses": ai.chunk_store.misses,
+        "in_flight": ai.inflight.in_flight(),
+        "upstreams": {u.name: u.metrics() for u in (ai.embeddings, ai.pinecone, ai.chat)},
+        "caches": {
+            "answer": ai.answer_cache.metrics(),
+            "context": ai.context_cache.metrics(),
+            "embedding": ai.embedding_cache.metrics(),
+        },
+    }
+
 @app.get("/livekit/status")
 async def livekit_status():
     return {
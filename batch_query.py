@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import json
+import logging
+import sys
+import time
+from typing import Dict, List
+
+
+def parse_jsonl(body: str) -> List[Dict]:
+    """Parse one question per line: {"id": ..., "text": ...} or a bare JSON string."""
+    items = []
+    for line_number, line in enumerate(body.splitlines(), start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            item = json.loads(line)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Line {line_number}: invalid JSON ({e.msg})")
+        if isinstance(item, str):
+            item = {"text": item}
+        if not isinstance(item, dict) or not isinstance(item.get("text"), str) or not item["text"].strip():
+            raise ValueError(f"Line {line_number}: expected an object with a non-empty \"text\" field")
+        items.append(item)
+    return items
+
+
+async def run(path: str, concurrency: int, output):
+    # Imported here so argument errors do not pay for loading the API module
+    from api import ai
+
+    with open(path, 'r', encoding='utf-8') as f:
+        items = parse_jsonl(f.read())
+
+    await ai.warmup()
+    started = time.monotonic()
+    done = failed = 0
+    async for record in ai.batch_answer(items, concurrency=concurrency):
+        output.write(json.dumps(record, ensure_ascii=False) + "\n")
+        output.flush()
+        done += 1
+        failed += "error" in record
+        if done % 100 == 0:
+            logging.info(f"{done}/{len(items)} answered ({time.monotonic() - started:.0f}s)")
+    logging.info(f"Finished {done} questions ({failed} failed) in {time.monotonic() - started:.1f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Answer a JSONL file of questions, writing NDJSON results")
+    parser.add_argument("questions", help="JSONL file, one {\"id\", \"text\"} object per line")
+    parser.add_argument("-o", "--output", help="NDJSON output file (default: stdout)")
+    parser.add_argument("-c", "--concurrency", type=int, default=32, help="parallel retrievals/completions")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    output = open(args.output, 'w', encoding='utf-8') if args.output else sys.stdout
+    try:
+        asyncio.run(run(args.questions, args.concurrency, output))
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,33 +1,132 @@
 import os
+import sys
+import asyncio
+import functools
 import logging
+import time
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, MessageHandler, CommandHandler, CallbackQueryHandler, filters, ContextTypes
 import openai
 from pinecone import Pinecone
 import tempfile
+import threading
 from dotenv import load_dotenv
-from chat_manager import ChatManager
+from chat_manager import ChatManager, compaction_loop
+from chunk_store import open_default_store
+from single_flight import SingleFlight, coalesce_key
+from resilience import retry_with_backoff
+from tracing import annotate, install_log_context, stage, tracer_from_env
+from admission import Overloaded, PRIORITY_TEXT, PRIORITY_VOICE_TO_VOICE, admission_from_env, rate_limiter_from_env
 
 # Load environment variables
 load_dotenv()
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
+install_log_context()
 logger = logging.getLogger(__name__)
 
 class ArabicVoiceBot:
     def __init__(self):
-        # Initialize APIs
+        # Initialize APIs; the Pinecone handle is connected in warmup()
         self.openai_client = openai.OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
-        pc = Pinecone(api_key=os.getenv('PINECONE_API_KEY'))
-        self.index = pc.Index(os.getenv('PINECONE_INDEX_NAME'))
+        self.index = None
         self.chat_manager = ChatManager()
-        self.user_sessions = {}  # user_id -> current_session_id
+        self.chunk_store = open_default_store()
+        self.inflight = SingleFlight()
+        self.rate_limiter = rate_limiter_from_env()
+        self.admission = admission_from_env()
+        self.tracer = tracer_from_env()
+        self._chat_locks = {}
+        
+    async def warmup(self):
+        # Retried in the background so a Pinecone hiccup does not crash the bot into a restart loop
+        self.index = await retry_with_backoff(self._connect_pinecone, "Connecting to Pinecone")
+        logger.info("Bot ready")
         
+        # Archive idle sessions into compressed per-user packs
+        await compaction_loop(self.chat_manager)
+    
+    def _connect_pinecone(self):
+        pc = Pinecone(api_key=os.getenv('PINECONE_API_KEY'))
+        return pc.Index(os.getenv('PINECONE_INDEX_NAME'))
+    
     def _get_or_create_session(self, user_id: int) -> str:
-        if user_id not in self.user_sessions:
-            self.user_sessions[user_id] = self.chat_manager.create_session(user_id)
-        return self.user_sessions[user_id]
+        session_id = self.chat_manager.get_active_session(user_id)
+        if not session_id:
+            session_id = self.chat_manager.create_session(user_id)
+            self.chat_manager.set_active_session(user_id, session_id)
+        return session_id
+    
+    def admitted(self, handler, priority: int):
+        # Per-user rate limit and bounded priority queue around a message handler
+        async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            if self.index is None:
+                await update.message.reply_text("البوت قيد التهيئة، يرجى المحاولة بعد لحظات")
+                return
+            allowed, _ = self.rate_limiter.allow(f"user:{update.effective_user.id}")
+            if not allowed:
+                await update.message.reply_text("لقد أرسلت رسائل كثيرة، يرجى الانتظار قليلاً ثم المحاولة مجدداً")
+                return
+            try:
+                with self.tracer.request(
+                    f"bot.{handler.__name__}", f"tg-{update.update_id}", user=update.effective_user.id
+                ):
+                    queued = time.monotonic()
+                    async with self.admission.slot(priority):
+                        annotate(queue_wait=round(time.monotonic() - queued, 4))
+                        await handler(update, context)
+            except Overloaded as e:
+                logger.warning(f"Shedding message ({e}), queue depth {self.admission.queue_depth}")
+                await update.message.reply_text("البوت مشغول حالياً، يرجى المحاولة بعد قليل")
+        return wrapper
+    
+    def in_chat_order(self, handler):
+        # Polling processes updates concurrently; this keeps each chat's updates in arrival order
+        async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            chat_id = update.effective_chat.id if update.effective_chat else None
+            entry = self._chat_locks.setdefault(chat_id, [asyncio.Lock(), 0])
+            entry[1] += 1
+            try:
+                async with entry[0]:
+                    await handler(update, context)
+            finally:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._chat_locks[chat_id]
+        return wrapper
+    
+    async def _run(self, fn, *args, **kwargs):
+        # Blocking SDK calls run off the event loop so other chats keep being served
+        return await asyncio.get_event_loop().run_in_executor(None, functools.partial(fn, *args, **kwargs))
+    
+    async def _search(self, text: str):
+        # Identical questions from different chats share one lookup; a chat's own updates run one
+        # at a time, so its repeats never coalesce
+        with stage("search"):
+            return await self.inflight.do(coalesce_key(text), lambda: self._embed_and_query(text))
+    
+    async def _embed_and_query(self, text: str):
+        # Timed separately so an OpenAI stall can be told apart from a Pinecone one
+        with stage("embedding"):
+            embedding = await self._run(self._create_embedding, text)
+        with stage("pinecone"):
+            return await self._run(self._query_pinecone, embedding)
+    
+    def _create_embedding(self, text: str):
+        return self.openai_client.embeddings.create(
+            model="text-embedding-3-small",
+            input=text
+        ).data[0].embedding
+    
+    def _query_pinecone(self, embedding):
+        results = self.index.query(
+            vector=embedding,
+            top_k=10,
+            include_metadata=not len(self.chunk_store),  # Text is resolved locally when synced
+            include_values=False
+        )
+        return self.chunk_store.resolve_missing(self.index, results)
     
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         welcome_text = """مرحباً بك في مكتبة الرحيق المختوم 📚
@@ -61,7 +160,7 @@ class ArabicVoiceBot:
         
         if query.data == "new_chat":
             session_id = self.chat_manager.create_session(user_id)
-            self.user_sessions[user_id] = session_id
+            self.chat_manager.set_active_session(user_id, session_id)
             await query.edit_message_text(f"✅ تم إنشاء محادثة جديدة\nرقم المحادثة: {session_id}")
             
         elif query.data == "list_chats":
@@ -84,7 +183,7 @@ class ArabicVoiceBot:
         elif query.data.startswith("load_"):
             session_id = query.data.replace("load_", "")
             if self.chat_manager._load_session(user_id, session_id):
-                self.user_sessions[user_id] = session_id
+                self.chat_manager.set_active_session(user_id, session_id)
                 
                 # Show session options
                 keyboard = [
@@ -99,8 +198,8 @@ class ArabicVoiceBot:
         elif query.data.startswith("delete_"):
             session_id = query.data.replace("delete_", "")
             if self.chat_manager.delete_session(user_id, session_id):
-                if self.user_sessions.get(user_id) == session_id:
-                    del self.user_sessions[user_id]
+                if self.chat_manager.get_active_session(user_id) == session_id:
+                    self.chat_manager.set_active_session(user_id, None)
                 await query.edit_message_text(f"✅ تم حذف المحادثة: {session_id}")
             else:
                 await query.edit_message_text("❌ المحادثة غير موجودة")
@@ -120,7 +219,7 @@ class ArabicVoiceBot:
     async def new_chat(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = update.effective_user.id
         session_id = self.chat_manager.create_session(user_id)
-        self.user_sessions[user_id] = session_id
+        self.chat_manager.set_active_session(user_id, session_id)
         await update.message.reply_text(f"تم إنشاء محادثة جديدة: {session_id}")
     
     async def load_chat(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -132,7 +231,7 @@ class ArabicVoiceBot:
         session_id = context.args[0]
         
         if self.chat_manager._load_session(user_id, session_id):
-            self.user_sessions[user_id] = session_id
+            self.chat_manager.set_active_session(user_id, session_id)
             await update.message.reply_text(f"تم تحميل المحادثة: {session_id}")
         else:
             await update.message.reply_text("المحادثة غير موجودة")
@@ -160,8 +259,8 @@ class ArabicVoiceBot:
         session_id = context.args[0]
         
         if self.chat_manager.delete_session(user_id, session_id):
-            if self.user_sessions.get(user_id) == session_id:
-                del self.user_sessions[user_id]
+            if self.chat_manager.get_active_session(user_id) == session_id:
+                self.chat_manager.set_active_session(user_id, None)
             await update.message.reply_text(f"تم حذف المحادثة: {session_id}")
         else:
             await update.message.reply_text("المحادثة غير موجودة")
@@ -169,57 +268,51 @@ class ArabicVoiceBot:
     async def handle_voice(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
             user_id = update.effective_user.id
-            session_id = self._get_or_create_session(user_id)
+            with stage("chat_history"):
+                session_id = self._get_or_create_session(user_id)
             
             # Send typing indicator and processing message
             await update.message.chat.send_action(action="typing")
             processing_msg = await update.message.reply_text("جار التحليل...")
             
             # Download voice message
-            voice_file = await update.message.voice.get_file()
+            with stage("download"):
+                voice_file = await update.message.voice.get_file()
             
             with tempfile.NamedTemporaryFile(suffix='.ogg', delete=False) as temp_file:
-                await voice_file.download_to_drive(temp_file.name)
+                with stage("download"):
+                    await voice_file.download_to_drive(temp_file.name)
                 
                 # Transcribe with OpenAI Whisper (supports .ogg directly)
                 await update.message.chat.send_action(action="typing")
-                with open(temp_file.name, 'rb') as audio_file:
-                    transcript = self.openai_client.audio.transcriptions.create(
-                        model="whisper-1",
-                        file=audio_file,
-                        language="ar"
-                    )
+                with stage("transcription"):
+                    with open(temp_file.name, 'rb') as audio_file:
+                        transcript = await self._run(
+                            self.openai_client.audio.transcriptions.create,
+                            model="whisper-1",
+                            file=audio_file,
+                            language="ar"
+                        )
                 
                 # Save user message to chat history
-                self.chat_manager.add_message(user_id, session_id, "user", transcript.text)
-                
-                # Get chat history for context
-                history = self.chat_manager.get_session_history(user_id, session_id)
-                
-                # Get embedding for the transcribed text
-                await update.message.chat.send_action(action="typing")
-                embedding_response = self.openai_client.embeddings.create(
-                    model="text-embedding-3-small",
-                    input=transcript.text
-                )
+                with stage("chat_history"):
+                    self.chat_manager.add_message(user_id, session_id, "user", transcript.text)
+                    
+                    # Get chat history for context
+                    history = self.chat_manager.get_session_history(user_id, session_id)
                 
-                # Query Pinecone
+                # Embed and query Pinecone; identical questions in flight share one round-trip
                 await update.message.chat.send_action(action="typing")
-                results = self.index.query(
-                    vector=embedding_response.data[0].embedding,
-                    top_k=10,
-                    include_metadata=True,
-                    include_values=False
-                )
+                results = await self._search(transcript.text)
                 
                 # Build context from Pinecone results
                 context_texts = []
                 for match in results.matches:
                     if match.score > 0.3:
-                        context_texts.append(match.metadata.get('text', ''))
+                        context_texts.append(self.chunk_store.match_text(match))
                 
                 if not context_texts:
-                    context_texts = [match.metadata.get('text', '') for match in results.matches[:3]]
+                    context_texts = [self.chunk_store.match_text(match) for match in results.matches[:3]]
                 
                 context_text = "\n".join(context_texts) if context_texts else "لا توجد معلومات متاحة في قاعدة البيانات"
                 if len(context_text) > 3000:
@@ -255,35 +348,41 @@ class ArabicVoiceBot:
 
 أسلوبك: علمي، محترم، واضح، يليق بمقام المرجعية الدينية."""
                 
-                response = self.openai_client.chat.completions.create(
-                    model="gpt-4o-mini",
-                    messages=[
-                        {"role": "system", "content": system_prompt},
-                        {"role": "user", "content": f"السياق المتوفر: {context_text}{history_context}\n\nالسؤال: {transcript.text}"}
-                    ],
-                    max_tokens=500
-                )
+                with stage("generation"):
+                    response = await self._run(
+                        self.openai_client.chat.completions.create,
+                        model="gpt-4o-mini",
+                        messages=[
+                            {"role": "system", "content": system_prompt},
+                            {"role": "user", "content": f"السياق المتوفر: {context_text}{history_context}\n\nالسؤال: {transcript.text}"}
+                        ],
+                        max_tokens=500
+                    )
                 
                 response_text = response.choices[0].message.content
                 
                 # Save assistant response to chat history
-                self.chat_manager.add_message(user_id, session_id, "assistant", response_text)
+                with stage("chat_history"):
+                    self.chat_manager.add_message(user_id, session_id, "assistant", response_text)
                 
                 # Convert response to speech
                 await update.message.chat.send_action(action="record_voice")
-                speech_response = self.openai_client.audio.speech.create(
-                    model="tts-1",
-                    voice="alloy",
-                    input=response_text
-                )
+                with stage("tts"):
+                    speech_response = await self._run(
+                        self.openai_client.audio.speech.create,
+                        model="tts-1",
+                        voice="alloy",
+                        input=response_text
+                    )
                 
                 # Save audio to temporary file
                 with tempfile.NamedTemporaryFile(suffix='.mp3', delete=False) as audio_file:
                     speech_response.stream_to_file(audio_file.name)
                     
                     # Send voice message
-                    with open(audio_file.name, 'rb') as voice:
-                        await update.message.reply_voice(voice=voice)
+                    with stage("send"):
+                        with open(audio_file.name, 'rb') as voice:
+                            await update.message.reply_voice(voice=voice)
                     
                     # Delete processing message
                     await processing_msg.delete()
@@ -305,39 +404,30 @@ class ArabicVoiceBot:
     async def handle_text(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
             user_id = update.effective_user.id
-            session_id = self._get_or_create_session(user_id)
+            with stage("chat_history"):
+                session_id = self._get_or_create_session(user_id)
             
             await update.message.chat.send_action(action="typing")
             
             # Save user message to chat history
-            self.chat_manager.add_message(user_id, session_id, "user", update.message.text)
-            
-            # Get chat history for context
-            history = self.chat_manager.get_session_history(user_id, session_id)
-            
-            # Get embedding for the text
-            embedding_response = self.openai_client.embeddings.create(
-                model="text-embedding-3-small",
-                input=update.message.text
-            )
+            with stage("chat_history"):
+                self.chat_manager.add_message(user_id, session_id, "user", update.message.text)
+                
+                # Get chat history for context
+                history = self.chat_manager.get_session_history(user_id, session_id)
             
-            # Query Pinecone
+            # Embed and query Pinecone; identical questions in flight share one round-trip
             await update.message.chat.send_action(action="typing")
-            results = self.index.query(
-                vector=embedding_response.data[0].embedding,
-                top_k=10,
-                include_metadata=True,
-                include_values=False
-            )
+            results = await self._search(update.message.text)
             
             # Build context from Pinecone results
             context_texts = []
             for match in results.matches:
                 if match.score > 0.3:
-                    context_texts.append(match.metadata.get('text', ''))
+                    context_texts.append(self.chunk_store.match_text(match))
             
             if not context_texts:
-                context_texts = [match.metadata.get('text', '') for match in results.matches[:3]]
+                context_texts = [self.chunk_store.match_text(match) for match in results.matches[:3]]
             
             context_text = "\n".join(context_texts) if context_texts else "لا توجد معلومات متاحة في قاعدة البيانات"
             if len(context_text) > 3000:
@@ -373,46 +463,91 @@ class ArabicVoiceBot:
 
 أسلوبك: علمي، محترم، واضح، يليق بمقام المرجعية الدينية."""
             
-            response = self.openai_client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": f"السياق المتوفر: {context_text}{history_context}\n\nالسؤال: {update.message.text}"}
-                ],
-                max_tokens=500
-            )
+            with stage("generation"):
+                response = await self._run(
+                    self.openai_client.chat.completions.create,
+                    model="gpt-4o-mini",
+                    messages=[
+                        {"role": "system", "content": system_prompt},
+                        {"role": "user", "content": f"السياق المتوفر: {context_text}{history_context}\n\nالسؤال: {update.message.text}"}
+                    ],
+                    max_tokens=500
+                )
             
             response_text = response.choices[0].message.content
             
             # Save assistant response to chat history
-            self.chat_manager.add_message(user_id, session_id, "assistant", response_text)
+            with stage("chat_history"):
+                self.chat_manager.add_message(user_id, session_id, "assistant", response_text)
             
-            await update.message.reply_text(response_text)
+            with stage("send"):
+                await update.message.reply_text(response_text)
                 
         except Exception as e:
             logger.error(f"Error processing text: {e}")
             await update.message.reply_text("عذراً، حدث خطأ في معالجة الرسالة")
 
-def main():
-    bot = ArabicVoiceBot()
-    
-    app = Application.builder().token(os.getenv('TELEGRAM_BOT_TOKEN')).build()
+def build_application(bot: ArabicVoiceBot, webhook: bool = False) -> Application:
+    builder = Application.builder().token(os.getenv('TELEGRAM_BOT_TOKEN'))
+    if webhook:
+        # Updates arrive over HTTP (see telegram_webhook.py), so no polling updater;
+        # its dispatcher already orders each chat's updates
+        builder = builder.updater(None)
+        ordered = lambda handler: handler
+    else:
+        async def post_init(application: Application):
+            application.create_task(bot.warmup())
+        # Without concurrent updates PTB handles one update at a time and the admission queue never fills
+        builder = builder.post_init(post_init).concurrent_updates(True)
+        ordered = bot.in_chat_order
+    app = builder.build()
     
     # Add command handlers
-    app.add_handler(CommandHandler("start", bot.start))
-    app.add_handler(CommandHandler("menu", bot.menu))
-    app.add_handler(CommandHandler("new_chat", bot.new_chat))
-    app.add_handler(CommandHandler("load_chat", bot.load_chat))
-    app.add_handler(CommandHandler("list_chats", bot.list_chats))
-    app.add_handler(CommandHandler("delete_chat", bot.delete_chat))
+    app.add_handler(CommandHandler("start", ordered(bot.start)))
+    app.add_handler(CommandHandler("menu", ordered(bot.menu)))
+    app.add_handler(CommandHandler("new_chat", ordered(bot.new_chat)))
+    app.add_handler(CommandHandler("load_chat", ordered(bot.load_chat)))
+    app.add_handler(CommandHandler("list_chats", ordered(bot.list_chats)))
+    app.add_handler(CommandHandler("delete_chat", ordered(bot.delete_chat)))
     
     # Add callback query handler for buttons
-    app.add_handler(CallbackQueryHandler(bot.button_handler))
+    app.add_handler(CallbackQueryHandler(ordered(bot.button_handler)))
     
     # Add message handlers
-    app.add_handler(MessageHandler(filters.VOICE, bot.handle_voice))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, bot.handle_text))
+    app.add_handler(MessageHandler(filters.VOICE, ordered(bot.admitted(bot.handle_voice, PRIORITY_VOICE_TO_VOICE))))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, ordered(bot.admitted(bot.handle_text, PRIORITY_TEXT))))
     
+    return app
+
+def serve_admin(bot: ArabicVoiceBot, port: int):
+    # Polling has no HTTP server, so the admin endpoints get their own on a background thread
+    import uvicorn
+    from fastapi import FastAPI
+    from tracing import admin_router
+    
+    app = FastAPI(title="Alrah AI Bot Admin")
+    app.include_router(admin_router(bot.tracer))
+    server = uvicorn.Server(uvicorn.Config(
+        app, host=os.getenv('BOT_ADMIN_HOST', '127.0.0.1'), port=port, log_level="warning"
+    ))
+    # Off the main thread uvicorn leaves signal handling to the polling loop
+    threading.Thread(target=server.run, name="bot-admin", daemon=True).start()
+    logger.info(f"Bot admin endpoints on port {port}")
+
+def main():
+    mode = sys.argv[1] if len(sys.argv) > 1 else os.getenv('BOT_MODE', 'polling')
+    
+    if mode in ("webhook", "set-webhook"):
+        from telegram_webhook import register_webhook, serve
+        asyncio.run(register_webhook())
+        if mode == "webhook":
+            serve()
+        return
+    
+    bot = ArabicVoiceBot()
+    app = build_application(bot)
+    if os.getenv('ADMIN_TOKEN') and os.getenv('BOT_ADMIN_PORT'):
+        serve_admin(bot, int(os.getenv('BOT_ADMIN_PORT')))
     app.run_polling()
 
 if __name__ == '__main__':
@@ -1,13 +1,194 @@
+import asyncio
+import fcntl
+import gzip
 import json
+import logging
 import os
+import time
 import uuid
+from collections import OrderedDict
 from datetime import datetime
-from typing import Dict, List, Optional
+from typing import Dict, Iterator, List, Optional
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+
+class SessionArchive:
+    """Per-user append-only packs of compressed cold sessions with a JSON offset index."""
+    
+    def __init__(self, base_dir: str):
+        self.base_dir = base_dir
+        os.makedirs(base_dir, exist_ok=True)
+        self._index_cache = {}  # user_id -> (mtime_ns, index)
+        # One archive-wide lock keeps each archived user at two files (pack and index)
+        self._lock_path = os.path.join(base_dir, ".lock")
+    
+    def get(self, user_id, session_id: str) -> Optional[Dict]:
+        try:
+            return self._get(user_id, session_id)
+        except Exception:
+            # A concurrent repack can move entries under a stale index; reread it once
+            self._index_cache.pop(user_id, None)
+            return self._get(user_id, session_id)
+    
+    def _get(self, user_id, session_id: str) -> Optional[Dict]:
+        entry = self._read_index(user_id)["sessions"].get(session_id)
+        if entry is None:
+            return None
+        with open(self._pack_path(user_id), 'rb') as f:
+            f.seek(entry["offset"])
+            blob = f.read(entry["length"])
+        return json.loads(self._decompress(blob, entry["codec"]))
+    
+    def list(self, user_id) -> Dict[str, Dict]:
+        return self._read_index(user_id)["sessions"]
+    
+    def iter_sessions(self) -> Iterator[Dict]:
+        for filename in sorted(os.listdir(self.base_dir)):
+            if not (filename.startswith("user_") and filename.endswith(".idx")):
+                continue
+            user_key = filename[len("user_"):-len(".idx")]
+            try:
+                entries = list(self._read_index(user_key)["sessions"].values())
+                with open(self._pack_path(user_key), 'rb') as f:
+                    for entry in entries:
+                        f.seek(entry["offset"])
+                        yield json.loads(self._decompress(f.read(entry["length"]), entry["codec"]))
+            except (OSError, ValueError) as e:
+                logger.warning(f"Skipping archive {filename}: {e}")
+    
+    def add(self, user_id, sessions: List[Dict]):
+        with self._locked():
+            index = self._read_index(user_id)
+            with open(self._pack_path(user_id), 'ab') as f:
+                for session_data in sessions:
+                    codec, blob = self._compress(
+                        json.dumps(session_data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+                    )
+                    offset = f.tell()
+                    f.write(blob)
+                    old = index["sessions"].get(session_data["session_id"])
+                    if old:
+                        index["garbage"] += old["length"]
+                    index["sessions"][session_data["session_id"]] = {
+                        "offset": offset,
+                        "length": len(blob),
+                        "codec": codec,
+                        "created_at": session_data["created_at"],
+                        "message_count": len(session_data["messages"]),
+                    }
+                f.flush()
+                os.fsync(f.fileno())
+            self._write_index(user_id, index)
+            self._maybe_repack(user_id, index)
+    
+    def remove(self, user_id, session_id: str) -> bool:
+        if session_id not in self._read_index(user_id)["sessions"]:
+            return False
+        with self._locked():
+            index = self._read_index(user_id)
+            entry = index["sessions"].pop(session_id, None)
+            if entry is None:
+                return False
+            if not index["sessions"]:
+                # Index first, so readers never see an index pointing into a missing pack
+                os.remove(self._index_path(user_id))
+                os.remove(self._pack_path(user_id))
+                self._index_cache.pop(user_id, None)
+                return True
+            index["garbage"] += entry["length"]
+            self._write_index(user_id, index)
+            self._maybe_repack(user_id, index)
+        return True
+    
+    def _maybe_repack(self, user_id, index: Dict):
+        # Rewrite the pack once more than half of it belongs to replaced or deleted sessions
+        pack_path = self._pack_path(user_id)
+        if index["garbage"] * 2 <= os.path.getsize(pack_path):
+            return
+        tmp_path = pack_path + ".tmp"
+        with open(pack_path, 'rb') as src, open(tmp_path, 'wb') as dst:
+            for entry in index["sessions"].values():
+                src.seek(entry["offset"])
+                blob = src.read(entry["length"])
+                entry["offset"] = dst.tell()
+                dst.write(blob)
+        index["garbage"] = 0
+        os.replace(tmp_path, pack_path)
+        self._write_index(user_id, index)
+    
+    @staticmethod
+    def _compress(data: bytes):
+        if zstandard is not None:
+            return "zstd", zstandard.ZstdCompressor(level=10).compress(data)
+        return "gzip", gzip.compress(data, compresslevel=9)
+    
+    @staticmethod
+    def _decompress(blob: bytes, codec: str) -> bytes:
+        if codec == "zstd":
+            return zstandard.ZstdDecompressor().decompress(blob)
+        return gzip.decompress(blob)
+    
+    def _read_index(self, user_id) -> Dict:
+        index_path = self._index_path(user_id)
+        try:
+            mtime = os.stat(index_path).st_mtime_ns
+        except FileNotFoundError:
+            return {"sessions": {}, "garbage": 0}
+        cached = self._index_cache.get(user_id)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        with open(index_path, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        self._index_cache[user_id] = (mtime, index)
+        return index
+    
+    def _write_index(self, user_id, index: Dict):
+        index_path = self._index_path(user_id)
+        tmp_path = f"{index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(index, f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(tmp_path, index_path)
+        self._index_cache.pop(user_id, None)
+    
+    def _locked(self):
+        # Pack writes are rare batch operations, so serializing them across users costs little
+        return _FileLock(self._lock_path)
+    
+    def _pack_path(self, user_id) -> str:
+        return os.path.join(self.base_dir, f"user_{user_id}.pack")
+    
+    def _index_path(self, user_id) -> str:
+        return os.path.join(self.base_dir, f"user_{user_id}.idx")
+
+
+class _FileLock:
+    # Serializes pack writers across bot and API processes
+    def __init__(self, path: str):
+        self.path = path
+    
+    def __enter__(self):
+        self._file = open(self.path, 'a')
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        return self
+    
+    def __exit__(self, *exc):
+        fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._file.close()
+
 
 class ChatManager:
     def __init__(self, base_dir: str = "chat_history"):
         self.base_dir = base_dir
         os.makedirs(base_dir, exist_ok=True)
+        self.archive = SessionArchive(os.path.join(base_dir, "archive"))
+        # Held by session writes and by compaction's check-then-remove, across processes
+        self._lock_path = os.path.join(base_dir, ".lock")
         
     def create_session(self, user_id: int) -> str:
         session_id = str(uuid.uuid4())[:8]
@@ -35,30 +216,119 @@ class ChatManager:
         return session_data["messages"] if session_data else []
     
     def list_user_sessions(self, user_id: int) -> List[Dict]:
-        sessions = []
+        # Archived sessions are listed from the pack index without decompressing them
+        sessions = {
+            session_id: {
+                "session_id": session_id,
+                "created_at": entry["created_at"],
+                "message_count": entry["message_count"]
+            }
+            for session_id, entry in self.archive.list(user_id).items()
+        }
         for filename in os.listdir(self.base_dir):
             if filename.startswith(f"user_{user_id}_"):
                 session_id = filename.replace(f"user_{user_id}_", "").replace(".json", "")
-                session_data = self._load_session(user_id, session_id)
+                session_data = self._load_hot_session(user_id, session_id)
                 if session_data:
-                    sessions.append({
+                    sessions[session_id] = {
                         "session_id": session_id,
                         "created_at": session_data["created_at"],
                         "message_count": len(session_data["messages"])
-                    })
-        return sorted(sessions, key=lambda x: x["created_at"], reverse=True)
+                    }
+        return sorted(sessions.values(), key=lambda x: x["created_at"], reverse=True)
     
     def delete_session(self, user_id: int, session_id: str) -> bool:
+        deleted = self.archive.remove(user_id, session_id)
         filepath = self._get_filepath(user_id, session_id)
         if os.path.exists(filepath):
             os.remove(filepath)
-            return True
-        return False
+            deleted = True
+        return deleted
+    
+    def iter_sessions(self) -> Iterator[Dict]:
+        """Every stored session: loose files first, then archived ones they do not supersede."""
+        seen = set()
+        for filename in os.listdir(self.base_dir):
+            if not (filename.startswith("user_") and filename.endswith(".json")):
+                continue
+            try:
+                with open(os.path.join(self.base_dir, filename), 'r', encoding='utf-8') as f:
+                    session_data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            seen.add((str(session_data["user_id"]), session_data["session_id"]))
+            yield session_data
+        for session_data in self.archive.iter_sessions():
+            if (str(session_data["user_id"]), session_data["session_id"]) not in seen:
+                yield session_data
+    
+    def compact(self, idle_seconds: float) -> int:
+        """Move sessions untouched for idle_seconds from loose JSON files into per-user packs."""
+        cutoff = time.time() - idle_seconds
+        cold = {}  # user_id -> [(filepath, mtime, session_data)]
+        for filename in os.listdir(self.base_dir):
+            if not (filename.startswith("user_") and filename.endswith(".json")):
+                continue
+            filepath = os.path.join(self.base_dir, filename)
+            try:
+                mtime = os.stat(filepath).st_mtime
+                if mtime > cutoff:
+                    continue
+                with open(filepath, 'r', encoding='utf-8') as f:
+                    session_data = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Skipping {filename} during compaction: {e}")
+                continue
+            cold.setdefault(session_data["user_id"], []).append((filepath, mtime, session_data))
+        
+        moved = 0
+        for user_id, entries in cold.items():
+            self.archive.add(user_id, [session_data for _, _, session_data in entries])
+            for filepath, mtime, _ in entries:
+                # A session written to since we read it stays hot; its loose file takes precedence
+                with _FileLock(self._lock_path):
+                    try:
+                        if os.stat(filepath).st_mtime == mtime:
+                            os.remove(filepath)
+                            moved += 1
+                    except FileNotFoundError:
+                        pass
+        if moved:
+            logger.info(f"Archived {moved} idle sessions")
+        return moved
+    
+    def get_active_session(self, user_id: int) -> Optional[str]:
+        filepath = self._get_active_filepath(user_id)
+        if os.path.exists(filepath):
+            with open(filepath, 'r', encoding='utf-8') as f:
+                return f.read().strip() or None
+        return None
+    
+    def set_active_session(self, user_id: int, session_id: Optional[str]):
+        # Stored on disk so every bot process agrees on the user's current session
+        filepath = self._get_active_filepath(user_id)
+        if session_id is None:
+            if os.path.exists(filepath):
+                os.remove(filepath)
+            return
+        tmp_path = f"{filepath}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(session_id)
+        os.replace(tmp_path, filepath)
+    
+    def _get_active_filepath(self, user_id: int) -> str:
+        return os.path.join(self.base_dir, f"active_{user_id}")
     
     def _get_filepath(self, user_id: int, session_id: str) -> str:
         return os.path.join(self.base_dir, f"user_{user_id}_{session_id}.json")
     
     def _load_session(self, user_id: int, session_id: str) -> Optional[Dict]:
+        session_data = self._load_hot_session(user_id, session_id)
+        if session_data is None:
+            session_data = self.archive.get(user_id, session_id)
+        return session_data
+    
+    def _load_hot_session(self, user_id: int, session_id: str) -> Optional[Dict]:
         filepath = self._get_filepath(user_id, session_id)
         if os.path.exists(filepath):
             with open(filepath, 'r', encoding='utf-8') as f:
@@ -67,5 +337,70 @@ class ChatManager:
     
     def _save_session(self, user_id: int, session_id: str, data: Dict):
         filepath = self._get_filepath(user_id, session_id)
-        with open(filepath, 'w', encoding='utf-8') as f:
+        with _FileLock(self._lock_path), open(filepath, 'w', encoding='utf-8') as f:
             json.dump(data, f, ensure_ascii=False, indent=2)
+
+
+class SessionCache:
+    """Hot in-memory cache of recent sessions in front of a ChatManager; writes go through to disk."""
+    
+    def __init__(self, chat_manager: ChatManager, max_sessions: int = 1000):
+        self.chat_manager = chat_manager
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()
+    
+    def create_session(self, user_id) -> str:
+        return self.chat_manager.create_session(user_id)
+    
+    def has_session(self, user_id, session_id: str) -> bool:
+        return self._get(user_id, session_id) is not None
+    
+    def get_session_history(self, user_id, session_id: str) -> List[Dict]:
+        session_data = self._get(user_id, session_id)
+        return list(session_data["messages"]) if session_data else []
+    
+    def add_message(self, user_id, session_id: str, role: str, content: str):
+        session_data = self._get(user_id, session_id)
+        if session_data:
+            session_data["messages"].append({
+                "role": role,
+                "content": content,
+                "timestamp": datetime.now().isoformat()
+            })
+            self.chat_manager._save_session(user_id, session_id, session_data)
+    
+    def _get(self, user_id, session_id: str) -> Optional[Dict]:
+        key = (user_id, session_id)
+        session_data = self._sessions.get(key)
+        if session_data is not None:
+            self._sessions.move_to_end(key)
+            return session_data
+        session_data = self.chat_manager._load_session(user_id, session_id)
+        if session_data is not None:
+            self._sessions[key] = session_data
+            if len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        return session_data
+
+
+async def compaction_loop(chat_manager: ChatManager):
+    """Background job archiving idle sessions; safe to run in several processes at once."""
+    idle_seconds = float(os.getenv('CHAT_ARCHIVE_AFTER_DAYS', '7')) * 86400
+    interval = float(os.getenv('CHAT_COMPACTION_INTERVAL_SECONDS', '3600'))
+    while True:
+        try:
+            await asyncio.get_event_loop().run_in_executor(None, chat_manager.compact, idle_seconds)
+        except Exception as e:
+            logger.error(f"Chat history compaction failed: {e}")
+        await asyncio.sleep(interval)
+
+
+if __name__ == "__main__":
+    import sys
+    
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) < 2 or sys.argv[1] != "compact":
+        print("Usage: python chat_manager.py compact [idle_days]")
+        sys.exit(1)
+    days = float(sys.argv[2]) if len(sys.argv) > 2 else float(os.getenv('CHAT_ARCHIVE_AFTER_DAYS', '7'))
+    print(f"Archived {ChatManager().compact(days * 86400)} sessions")
@@ -0,0 +1,223 @@
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+from typing import Iterable, Iterator, Optional, Tuple
+
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+# On-disk layout:
+#   chunks.idx  - header + fixed-size records sorted by id hash
+#   chunks.dat  - zlib-compressed "<id>\0<text>" blocks
+MAGIC = b"ARCS"
+VERSION = 1
+HEADER = struct.Struct("<4sII")      # magic, version, record count
+RECORD = struct.Struct("<QQI")       # id hash, blob offset, blob length
+MAX_FETCHED = 10000                  # Texts fetched for chunks missing locally, kept until the next reload
+
+
+def _hash_id(chunk_id: str) -> int:
+    return int.from_bytes(hashlib.blake2b(chunk_id.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+class ChunkStore:
+    """Memory-mapped chunk text store keyed by vector ID."""
+
+    def __init__(self, base_dir: str = "chunk_store", check_interval: float = 30.0):
+        self.base_dir = base_dir
+        self.index_path = os.path.join(base_dir, "chunks.idx")
+        self.data_path = os.path.join(base_dir, "chunks.dat")
+        self.check_interval = check_interval
+        # (index mmap, data mmap, count), swapped as one so readers never mix two versions
+        self._maps = (None, None, 0)
+        self._mtime_ns = None
+        self._checked = time.monotonic()
+        self._fetched = {}
+        self._lock = threading.Lock()
+        self.misses = 0
+        self.generation = 0
+        self.reload()
+
+    def __len__(self) -> int:
+        return self._maps[2]
+
+    def reload(self):
+        """Open the current files; readers still holding the old maps finish on them."""
+        try:
+            self._mtime_ns = os.stat(self.index_path).st_mtime_ns
+        except OSError:
+            self._mtime_ns = None
+        maps = self._open()
+        self._maps = maps or (None, None, 0)
+        with self._lock:
+            self._fetched = {}
+        self.generation += 1
+        if maps:
+            logger.info(f"Loaded chunk store with {maps[2]} chunks")
+
+    def refresh(self) -> bool:
+        """Reload when `chunk_store.py sync` has replaced the files; checks at most every check_interval."""
+        now = time.monotonic()
+        if now - self._checked < self.check_interval:
+            return False
+        self._checked = now
+        try:
+            mtime_ns = os.stat(self.index_path).st_mtime_ns
+        except OSError:
+            return False
+        if mtime_ns == self._mtime_ns:
+            return False
+        self.reload()
+        return True
+
+    def _open(self):
+        if not (os.path.exists(self.index_path) and os.path.exists(self.data_path)):
+            return None
+        try:
+            with open(self.index_path, 'rb') as f:
+                idx = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, version, count = HEADER.unpack_from(idx, 0)
+            if magic != MAGIC or version != VERSION:
+                idx.close()
+                logger.warning(f"Ignoring chunk store with unknown format: {self.index_path}")
+                return None
+            with open(self.data_path, 'rb') as f:
+                dat = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else None
+        except (OSError, ValueError, struct.error) as e:
+            logger.warning(f"Could not open chunk store: {e}")
+            return None
+        return idx, dat, count
+
+    def close(self):
+        idx, dat, _ = self._maps
+        self._maps = (None, None, 0)
+        for m in (idx, dat):
+            if m is not None:
+                m.close()
+        with self._lock:
+            self._fetched = {}
+
+    def get(self, chunk_id: str, default: Optional[str] = None) -> Optional[str]:
+        idx, dat, count = self._maps
+        if not count:
+            return default
+        key = _hash_id(chunk_id)
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            h, _, _ = RECORD.unpack_from(idx, HEADER.size + mid * RECORD.size)
+            if h < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        # Walk forward over records sharing the hash to rule out collisions
+        while lo < count:
+            h, offset, length = RECORD.unpack_from(idx, HEADER.size + lo * RECORD.size)
+            if h != key:
+                break
+            stored_id, _, text = zlib.decompress(dat[offset:offset + length]).partition(b"\0")
+            if stored_id.decode('utf-8') == chunk_id:
+                return text.decode('utf-8')
+            lo += 1
+        return default
+
+    def items(self) -> Iterator[Tuple[str, str]]:
+        idx, dat, count = self._maps
+        for i in range(count):
+            _, offset, length = RECORD.unpack_from(idx, HEADER.size + i * RECORD.size)
+            stored_id, _, text = zlib.decompress(dat[offset:offset + length]).partition(b"\0")
+            yield stored_id.decode('utf-8'), text.decode('utf-8')
+
+    def match_text(self, match) -> str:
+        """Resolve a Pinecone match to its chunk text, locally when possible."""
+        text = self.get(match.id)
+        if text is None:
+            with self._lock:
+                text = self._fetched.get(match.id)
+        if text is not None:
+            return text
+        metadata = getattr(match, 'metadata', None) or {}
+        return metadata.get('text', '')
+
+    def resolve_missing(self, index, results, namespace: str = ""):
+        """Fetch text for matches indexed after the last sync, so a stale store never yields empty context."""
+        self.refresh()
+        if not len(self):
+            return results  # Metadata was requested with the query
+        with self._lock:
+            fetched = set(self._fetched)
+        missing = [m.id for m in results.matches if m.id not in fetched and self.get(m.id) is None]
+        if not missing:
+            return results
+        self.misses += len(missing)
+        logger.warning(f"{len(missing)} matched chunks missing from the local store; run `python chunk_store.py sync`")
+        response = index.fetch(ids=missing, namespace=namespace)
+        with self._lock:
+            if len(self._fetched) + len(missing) > MAX_FETCHED:
+                self._fetched = {}
+            for vector_id, vector in response.vectors.items():
+                self._fetched[vector_id] = (vector.metadata or {}).get('text', '')
+        return results
+
+    def write(self, chunks: Iterable[Tuple[str, str]]) -> int:
+        """Replace the store contents atomically with the given (id, text) pairs."""
+        os.makedirs(self.base_dir, exist_ok=True)
+        tmp_index, tmp_data = self.index_path + ".tmp", self.data_path + ".tmp"
+        records = []
+        offset = 0
+        with open(tmp_data, 'wb') as dat:
+            for chunk_id, text in chunks:
+                blob = zlib.compress(chunk_id.encode('utf-8') + b"\0" + text.encode('utf-8'), 6)
+                dat.write(blob)
+                records.append((_hash_id(chunk_id), offset, len(blob)))
+                offset += len(blob)
+        records.sort()
+        with open(tmp_index, 'wb') as idx:
+            idx.write(HEADER.pack(MAGIC, VERSION, len(records)))
+            for record in records:
+                idx.write(RECORD.pack(*record))
+        os.replace(tmp_data, self.data_path)
+        os.replace(tmp_index, self.index_path)
+        self.reload()
+        return len(records)
+
+
+def sync_from_pinecone(store: ChunkStore, index, namespace: str = "", batch_size: int = 100) -> int:
+    """Pull every chunk text out of the Pinecone index into the local store."""
+    def _chunks():
+        for ids in index.list(namespace=namespace):
+            for start in range(0, len(ids), batch_size):
+                batch = ids[start:start + batch_size]
+                fetched = index.fetch(ids=batch, namespace=namespace)
+                for vector_id, vector in fetched.vectors.items():
+                    text = (vector.metadata or {}).get('text')
+                    if text:
+                        yield vector_id, text
+
+    return store.write(_chunks())
+
+
+def open_default_store() -> ChunkStore:
+    return ChunkStore(os.getenv('CHUNK_STORE_DIR', 'chunk_store'))
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+
+    if len(sys.argv) < 2 or sys.argv[1] != "sync":
+        print("Usage: python chunk_store.py sync")
+        sys.exit(1)
+
+    from pinecone import Pinecone
+
+    pc = Pinecone(api_key=os.getenv('PINECONE_API_KEY'))
+    count = sync_from_pinecone(open_default_store(), pc.Index(os.getenv('PINECONE_INDEX_NAME')))
+    print(f"Synced {count} chunks")
@@ -0,0 +1,115 @@
+import logging
+import math
+import re
+from array import array
+from collections import Counter
+from typing import Dict, Iterable, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+_DIACRITICS = re.compile("[\u0610-\u061a\u064b-\u065f\u0670\u06d6-\u06ed\u0640]")
+_NON_WORD = re.compile(r"[^\w\s]")
+_CHAR_MAP = str.maketrans({
+    "أ": "ا", "إ": "ا", "آ": "ا", "ٱ": "ا",
+    "ى": "ي", "ئ": "ي", "ؤ": "و", "ة": "ه",
+})
+
+_PREFIXES = ("وال", "بال", "كال", "فال", "لل", "ال", "و")
+_SUFFIXES = ("ها", "ان", "ات", "ون", "ين", "يه", "ه", "ي")
+_STOPWORDS = {
+    "في", "من", "علي", "الي", "عن", "ان", "او", "ما", "لا", "هل", "هو", "هي",
+    "ذلك", "هذا", "هذه", "التي", "الذي", "كان", "مع", "ثم", "قد", "كل", "بين",
+    # Near-universal in the library, so they only cost time in search
+    "الله", "قال",
+}
+
+
+def normalize_arabic(text: str) -> str:
+    text = _DIACRITICS.sub("", text)
+    text = text.translate(_CHAR_MAP)
+    text = _NON_WORD.sub(" ", text)
+    return " ".join(text.split())
+
+
+def light_stem(word: str) -> str:
+    for prefix in _PREFIXES:
+        if word.startswith(prefix) and len(word) - len(prefix) >= 3:
+            word = word[len(prefix):]
+            break
+    for suffix in _SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            word = word[:-len(suffix)]
+            break
+    return word
+
+
+def tokenize(text: str) -> List[str]:
+    return [light_stem(w) for w in normalize_arabic(text).split() if w not in _STOPWORDS]
+
+
+def reciprocal_rank_fusion(*rankings: Iterable[str], k: int = 60) -> List[Tuple[str, float]]:
+    scores: Dict[str, float] = {}
+    for ranking in rankings:
+        for rank, chunk_id in enumerate(ranking):
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores.items(), key=lambda x: x[1], reverse=True)
+
+
+class LexicalIndex:
+    """In-memory BM25 inverted index over the library chunks."""
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.doc_ids: List[str] = []
+        self.doc_lengths = array('I')
+        self.postings: Dict[str, Tuple[array, array]] = {}
+        self.avg_length = 0.0
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+
+    def build(self, chunks: Iterable[Tuple[str, str]]) -> int:
+        doc_ids, doc_lengths, postings = [], array('I'), {}
+        for chunk_id, text in chunks:
+            terms = tokenize(text)
+            doc = len(doc_ids)
+            doc_ids.append(chunk_id)
+            doc_lengths.append(len(terms))
+            for term, tf in Counter(terms).items():
+                entry = postings.get(term)
+                if entry is None:
+                    entry = postings[term] = (array('I'), array('H'))
+                entry[0].append(doc)
+                entry[1].append(min(tf, 0xFFFF))
+        self.doc_ids, self.doc_lengths, self.postings = doc_ids, doc_lengths, postings
+        self.avg_length = (sum(doc_lengths) / len(doc_lengths) or 1.0) if doc_lengths else 0.0
+        logger.info(f"Built lexical index over {len(doc_ids)} chunks, {len(postings)} terms")
+        return len(doc_ids)
+
+    def search(self, query: str, top_k: int = 10) -> List[Tuple[str, float]]:
+        if not self.doc_ids:
+            return []
+        n = len(self.doc_ids)
+        entries = [self.postings[term] for term in set(tokenize(query)) if term in self.postings]
+        # Terms in over half the chunks barely move the ranking but dominate the cost; keep the
+        # rarest one only when the query has nothing else
+        rare = [entry for entry in entries if len(entry[0]) * 2 <= n]
+        if not rare and entries:
+            rare = [min(entries, key=lambda entry: len(entry[0]))]
+        scores: Dict[int, float] = {}
+        for docs, tfs in rare:
+            idf = math.log(1 + (n - len(docs) + 0.5) / (len(docs) + 0.5))
+            for doc, tf in zip(docs, tfs):
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[doc] / self.avg_length)
+                scores[doc] = scores.get(doc, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+        best = sorted(scores.items(), key=lambda x: x[1], reverse=True)[:top_k]
+        return [(self.doc_ids[doc], score) for doc, score in best]
+
+
+def is_exact_hit(query: str, text: str, min_words: int = 3) -> bool:
+    """True when the normalized query appears verbatim in the chunk text."""
+    normalized = normalize_arabic(query)
+    if len(normalized.split()) < min_words:
+        return False
+    return normalized in normalize_arabic(text)
@@ -5,6 +5,7 @@ from livekit.plugins import openai, silero
 import os
 from dotenv import load_dotenv
 from pinecone import Pinecone
+from chunk_store import open_default_store
 
 # Load environment variables
 load_dotenv()
@@ -16,6 +17,7 @@ class AlrahAIAssistant:
         # Initialize Pinecone
         pc = Pinecone(api_key=os.getenv('PINECONE_API_KEY'))
         self.index = pc.Index(os.getenv('PINECONE_INDEX_NAME'))
+        self.chunk_store = open_default_store()
         
         # Initialize OpenAI client for embeddings
         import openai as openai_client
@@ -36,7 +38,7 @@ class AlrahAIAssistant:
         context_texts = []
         for match in results.matches[:3]:
             if match.score > 0.3:
-                context_texts.append(match.metadata.get('text', ''))
+                context_texts.append(self.chunk_store.match_text(match))
         
         context_text = "\n".join(context_texts) if context_texts else "لا توجد معلومات متاحة"
         if len(context_text) > 1000:
@@ -51,12 +53,13 @@ class AlrahAIAssistant:
         ).data[0].embedding
     
     def _query_pinecone(self, embedding):
-        return self.index.query(
+        results = self.index.query(
             vector=embedding,
             top_k=3,
-            include_metadata=True,
+            include_metadata=not len(self.chunk_store),
             include_values=False
         )
+        return self.chunk_store.resolve_missing(self.index, results)
 
 async def entrypoint(ctx: JobContext):
     # Initialize AI assistant
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import fcntl
+import glob
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter, OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from single_flight import coalesce_key
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache:
+    """Thread-safe LRU cache with a per-entry time-to-live."""
+
+    def __init__(self, max_items: int, ttl: float):
+        self.max_items = max_items
+        self.ttl = ttl
+        self._items: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None or item[0] < time.time():
+                if item is not None:
+                    del self._items[key]
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key: str, value: Any, expires_at: float = None):
+        with self._lock:
+            self._items[key] = (expires_at or time.time() + self.ttl, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def items(self) -> List[Tuple[str, float, Any]]:
+        now = time.time()
+        with self._lock:
+            return [(key, expires_at, value) for key, (expires_at, value) in self._items.items() if expires_at >= now]
+
+    def metrics(self) -> Dict:
+        total = self.hits + self.misses
+        return {"size": len(self._items), "hits": self.hits, "misses": self.misses,
+                "hit_ratio": round(self.hits / total, 3) if total else None}
+
+
+def save_snapshot(path: str, entries: List[Dict], limit: int = None):
+    """Merge entries into the snapshot, keeping the later-expiring entry per key.
+
+    Merging lets a prewarmed snapshot survive the old deploy's shutdown save."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path + ".lock", 'a') as lock:
+        # Serializes the read-merge-write across worker processes
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        now = time.time()
+        merged = {}
+        for entry in load_snapshot(path) + entries:
+            if entry["expires_at"] < now:
+                continue
+            current = merged.get(entry["key"])
+            if current is None or entry["expires_at"] > current["expires_at"]:
+                merged[entry["key"]] = entry
+        kept = sorted(merged.values(), key=lambda e: e["expires_at"], reverse=True)[:limit]
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+            json.dump({"created_at": now, "entries": kept}, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+
+def load_snapshot(path: str) -> List[Dict]:
+    if not os.path.exists(path):
+        return []
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        return json.load(f)["entries"]
+
+
+def mine_frequent_questions(chat_manager, query_log_path: str = None, limit: int = 500,
+                            min_count: int = 2) -> List[Tuple[str, int]]:
+    """Most frequent normalized user questions from chat history and the API query log."""
+    counts = Counter()
+    examples: Dict[str, str] = {}
+
+    def observe(text: str):
+        key = coalesce_key(text)
+        if len(key) < 3:
+            return
+        counts[key] += 1
+        examples.setdefault(key, text)
+
+    for session_data in chat_manager.iter_sessions():
+        for message in session_data.get("messages", []):
+            if message.get("role") == "user" and message.get("content"):
+                observe(message["content"])
+
+    if query_log_path:
+        # Include rotated logs (queries.jsonl.1, queries.jsonl.2.gz, ...) as well
+        for path in sorted(glob.glob(query_log_path + "*")):
+            opener = gzip.open if path.endswith(".gz") else open
+            with opener(path, 'rt', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        observe(json.loads(line)["q"])
+                    except (ValueError, KeyError, TypeError):
+                        continue
+
+    return [(examples[key], count) for key, count in counts.most_common(limit) if count >= min_count]
+
+
+async def prewarm(ai, questions: Iterable[str], concurrency: int = 4, per_second: float = 2.0,
+                  embed_batch: int = 100) -> int:
+    """Fill the AI caches for the given questions in throttled batches."""
+    loop = asyncio.get_event_loop()
+    questions = [q for q in questions if ai.answer_cache.get(coalesce_key(q)) is None]
+
+    # Embeddings first, in bulk
+    for start in range(0, len(questions), embed_batch):
+        batch = questions[start:start + embed_batch]
+        embeddings = await loop.run_in_executor(ai.executor, ai._create_embeddings, batch)
+        for question, embedding in zip(batch, embeddings):
+            ai.embedding_cache.set(coalesce_key(question), embedding)
+
+    # Then retrieval and answers through the normal pipeline, which stores them in the caches
+    slots = asyncio.Semaphore(concurrency)
+    warmed = 0
+
+    async def warm(position: int, question: str):
+        nonlocal warmed
+        await asyncio.sleep(position / per_second)
+        async with slots:
+            try:
+                await ai.search_and_respond(question, log_query=False)
+                # Extractive fallbacks are returned but never cached
+                if ai.answer_cache.get(coalesce_key(question)) is not None:
+                    warmed += 1
+            except Exception as e:
+                logger.warning(f"Could not prewarm question: {e}")
+
+    await asyncio.gather(*(warm(i, q) for i, q in enumerate(questions)))
+    return warmed
+
+
+async def _run(args):
+    from api import ai, sessions
+
+    await ai.warmup()
+    questions = mine_frequent_questions(
+        sessions.chat_manager, os.getenv('QUERY_LOG_PATH', 'logs/queries.jsonl'), args.top, args.min_count
+    )
+    logging.info(f"Prewarming {len(questions)} frequent questions")
+    warmed = await prewarm(ai, [q for q, _ in questions], args.concurrency, args.rate)
+    ai.save_cache_snapshot()
+    logging.info(f"Prewarmed {warmed} answers into {ai.cache_snapshot_path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Precompute cache entries for the most frequent questions")
+    parser.add_argument("command", choices=["prewarm"])
+    parser.add_argument("--top", type=int, default=500, help="number of frequent questions to warm")
+    parser.add_argument("--min-count", type=int, default=2, help="ignore questions asked fewer times")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--rate", type=float, default=2.0, help="questions started per second")
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_run(parser.parse_args()))
@@ -0,0 +1,177 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Callable, Dict
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class Deadline:
+    """Latency budget for one request, shared out across pipeline stages."""
+
+    def __init__(self, budget: float):
+        self.budget = budget
+        self.expires = time.monotonic() + budget
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires - time.monotonic())
+
+    def stage(self, share: float) -> float:
+        # A stage may use its share of the total budget, but never more than is left
+        return min(self.remaining(), self.budget * share)
+
+
+class LatencyTracker:
+    def __init__(self, window: int = 200, default: float = 1.0, min_samples: int = 20):
+        self.samples = deque(maxlen=window)
+        self.default = default
+        self.min_samples = min_samples
+
+    def record(self, seconds: float):
+        self.samples.append(seconds)
+
+    def percentile(self, q: float) -> float:
+        if len(self.samples) < self.min_samples:
+            return self.default
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+
+    def allow(self) -> bool:
+        if self.state == "half_open":
+            # One probe at a time; the rest fail fast until it reports back
+            if self.probing:
+                return False
+        elif self.state == "open":
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            # Let one probe call through; its outcome decides the state
+            self.state = "half_open"
+        else:
+            return True
+        self.probing = True
+        return True
+
+    def release(self):
+        """An allowed call ended without an outcome (cancelled); let another probe through."""
+        self.probing = False
+
+    def record_success(self):
+        self.state = "closed"
+        self.failures = 0
+        self.probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.probing = False
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            if self.state != "open":
+                logger.warning(f"Circuit for {self.name} opened after {self.failures} failures")
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+
+def _consume(future: asyncio.Future):
+    # Abandoned attempts still finish in their thread; swallow their outcome
+    if not future.cancelled():
+        future.exception()
+
+
+class Upstream:
+    """A blocking upstream client called through an executor with timeouts,
+    optional hedging after the observed p95 latency, and a circuit breaker."""
+
+    def __init__(self, name: str, executor, hedge: bool = False, default_latency: float = 1.0):
+        self.name = name
+        self.executor = executor
+        self.hedge = hedge
+        self.breaker = CircuitBreaker(name)
+        self.latency = LatencyTracker(default=default_latency)
+        self.hedged = 0
+        self.timeouts = 0
+
+    def metrics(self) -> Dict:
+        return {
+            "state": self.breaker.state,
+            "p50": round(self.latency.percentile(0.5), 3),
+            "p95": round(self.latency.percentile(0.95), 3),
+            "hedged": self.hedged,
+            "timeouts": self.timeouts,
+        }
+
+    async def call(self, fn: Callable, *args, timeout: float):
+        if not self.breaker.allow():
+            raise CircuitOpen(self.name)
+
+        loop = asyncio.get_event_loop()
+
+        def launch():
+            future = loop.run_in_executor(self.executor, fn, *args)
+            future.add_done_callback(_consume)
+            return future
+
+        start = time.monotonic()
+        expires = start + timeout
+        hedge_at = start + self.latency.percentile(0.95) if self.hedge else None
+        pending = {launch()}
+        last_error = None
+        try:
+            while pending:
+                now = time.monotonic()
+                if now >= expires:
+                    self.timeouts += 1
+                    raise asyncio.TimeoutError(f"{self.name} exceeded {timeout:.2f}s")
+                wake = min(expires, hedge_at) if hedge_at is not None else expires
+                done, pending = await asyncio.wait(
+                    pending, timeout=max(0.0, wake - now), return_when=asyncio.FIRST_COMPLETED
+                )
+                for future in done:
+                    if future.exception() is None:
+                        self.latency.record(time.monotonic() - start)
+                        self.breaker.record_success()
+                        return future.result()
+                    last_error = future.exception()
+                if hedge_at is not None and time.monotonic() >= hedge_at:
+                    hedge_at = None
+                    if pending:
+                        self.hedged += 1
+                        pending.add(launch())
+            raise last_error
+        except BaseException as e:
+            if isinstance(e, asyncio.CancelledError):
+                self.breaker.release()
+            else:
+                self.breaker.record_failure()
+            raise
+
+
+async def retry_with_backoff(fn: Callable, what: str, executor=None, initial_delay: float = 1.0,
+                             max_delay: float = 30.0, on_retry: Callable = None):
+    """Run a blocking call (or a coroutine function) until it succeeds, backing off between attempts."""
+    delay = initial_delay
+    while True:
+        try:
+            if asyncio.iscoroutinefunction(fn):
+                return await fn()
+            return await asyncio.get_event_loop().run_in_executor(executor, fn)
+        except Exception as e:
+            logger.warning(f"{what} failed ({e!r}), retrying in {delay:.0f}s")
+            if on_retry:
+                on_retry(e)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, max_delay)
@@ -0,0 +1,100 @@
+import asyncio
+import logging
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+from lexical_index import normalize_arabic
+
+logger = logging.getLogger(__name__)
+
+
+def coalesce_key(text: str) -> str:
+    """Identical questions modulo diacritics, letter variants, punctuation and spacing share a key."""
+    return normalize_arabic(text).lower()
+
+
+class _Broadcast:
+    def __init__(self):
+        self.chunks: List[Any] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.changed = asyncio.Event()
+
+    def _notify(self):
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+    def publish(self, chunk):
+        self.chunks.append(chunk)
+        self._notify()
+
+    def finish(self, error: Optional[BaseException] = None):
+        self.done = True
+        self.error = error
+        self._notify()
+
+    async def subscribe(self) -> AsyncIterator[Any]:
+        position = 0
+        while True:
+            changed = self.changed
+            while position < len(self.chunks):
+                yield self.chunks[position]
+                position += 1
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            await changed.wait()
+
+
+class SingleFlight:
+    """Shares one upstream execution between identical in-flight requests."""
+
+    def __init__(self):
+        self._calls: Dict[str, asyncio.Future] = {}
+        self._streams: Dict[str, _Broadcast] = {}
+        self.coalesced = 0
+
+    def in_flight(self) -> int:
+        return len(self._calls) + len(self._streams)
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        future = self._calls.get(key)
+        if future is None:
+            future = asyncio.ensure_future(fn())
+            self._calls[key] = future
+            future.add_done_callback(lambda f: self._forget(self._calls, key, f))
+        else:
+            self.coalesced += 1
+            logger.debug(f"Coalesced request onto in-flight call: {key[:50]}")
+        # Shield so one waiter disconnecting does not cancel the call for the others
+        return await asyncio.shield(future)
+
+    async def stream(self, key: str, fn: Callable[[], AsyncIterator[Any]]) -> AsyncIterator[Any]:
+        """Like do() for async generators; late subscribers replay chunks already produced."""
+        broadcast = self._streams.get(key)
+        if broadcast is None:
+            broadcast = _Broadcast()
+            self._streams[key] = broadcast
+            asyncio.ensure_future(self._produce(key, broadcast, fn))
+        else:
+            self.coalesced += 1
+        async for chunk in broadcast.subscribe():
+            yield chunk
+
+    async def _produce(self, key: str, broadcast: _Broadcast, fn: Callable[[], AsyncIterator[Any]]):
+        try:
+            async for chunk in fn():
+                broadcast.publish(chunk)
+        except BaseException as e:
+            # Includes cancellation, so subscribers are never left waiting on a dead producer
+            broadcast.finish(e if isinstance(e, Exception) else RuntimeError(f"Stream producer stopped: {e!r}"))
+            raise
+        else:
+            broadcast.finish()
+        finally:
+            self._forget(self._streams, key, broadcast)
+
+    @staticmethod
+    def _forget(table: Dict, key: str, value):
+        if table.get(key) is value:
+            del table[key]
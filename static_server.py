@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+import posixpath
+import ssl
+import threading
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+from urllib.parse import unquote, urlsplit
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# Only demo assets are served; never .env, keys or chat history from the project directory
+ALLOWED_EXTENSIONS = {'.html', '.js', '.css', '.map', '.png', '.jpg', '.svg', '.ico', '.wasm'}
+COMPRESSIBLE_EXTENSIONS = {'.html', '.js', '.css', '.map', '.svg'}
+
+
+class Asset:
+    def __init__(self, path: str, stat: os.stat_result):
+        with open(path, 'rb') as f:
+            data = f.read()
+        self.mtime_ns = stat.st_mtime_ns
+        self.size = stat.st_size
+        self.last_modified = formatdate(stat.st_mtime, usegmt=True)
+        self.content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        if self.content_type.startswith('text/') or self.content_type == 'application/javascript':
+            self.content_type += '; charset=utf-8'
+        self.cache_control = 'no-cache' if path.endswith('.html') else 'public, max-age=3600'
+
+        # Compressed variants are built once per file version, not per request
+        digest = hashlib.sha256(data).hexdigest()[:32]
+        self.variants: Dict[str, bytes] = {'identity': data}
+        self.etags: Dict[str, str] = {'identity': f'"{digest}"'}
+        if os.path.splitext(path)[1] in COMPRESSIBLE_EXTENSIONS and len(data) > 1024:
+            self.variants['gzip'] = gzip.compress(data, compresslevel=9, mtime=0)
+            self.etags['gzip'] = f'"{digest}-gz"'
+            if brotli is not None:
+                self.variants['br'] = brotli.compress(data, quality=11)
+                self.etags['br'] = f'"{digest}-br"'
+
+
+class AssetCache:
+    def __init__(self, root: str):
+        self.root = os.path.abspath(root)
+        self._assets: Dict[str, Asset] = {}
+        self._lock = threading.Lock()
+
+    def warm(self):
+        for name in sorted(os.listdir(self.root)):
+            if os.path.splitext(name)[1] in ALLOWED_EXTENSIONS:
+                self.get('/' + name)
+
+    def resolve(self, url_path: str) -> Optional[str]:
+        path = posixpath.normpath(unquote(url_path))
+        if path in ('/', '.'):
+            path = '/index.html'
+        full_path = os.path.abspath(os.path.join(self.root, path.lstrip('/')))
+        if not full_path.startswith(self.root + os.sep):
+            return None
+        if os.path.splitext(full_path)[1] not in ALLOWED_EXTENSIONS:
+            return None
+        return full_path
+
+    def get(self, url_path: str) -> Optional[Asset]:
+        full_path = self.resolve(url_path)
+        if full_path is None:
+            return None
+        try:
+            stat = os.stat(full_path)
+        except OSError:
+            return None
+        asset = self._assets.get(full_path)
+        if asset is None or asset.mtime_ns != stat.st_mtime_ns or asset.size != stat.st_size:
+            with self._lock:
+                asset = Asset(full_path, stat)
+                self._assets[full_path] = asset
+        return asset
+
+
+def _accepted_encodings(header: str) -> set:
+    accepted = set()
+    for part in header.split(','):
+        token, _, params = part.strip().partition(';')
+        if params.strip().replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            continue
+        accepted.add(token.strip().lower())
+    return accepted
+
+
+def _parse_range(header: str, size: int):
+    """Return (start, end) for a single byte range, None to ignore the header, or False if unsatisfiable."""
+    unit, _, spec = header.partition('=')
+    if unit.strip() != 'bytes' or ',' in spec:
+        return None
+    start, _, end = spec.strip().partition('-')
+    try:
+        if start:
+            first = int(start)
+            last = int(end) if end else size - 1
+        else:
+            first = max(0, size - int(end))
+            last = size - 1
+    except ValueError:
+        return None
+    if first >= size or first > last:
+        return False
+    return first, min(last, size - 1)
+
+
+class StaticHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep-alive between asset requests
+    server_version = 'AlrahStatic/1.0'
+    timeout = 30  # Idle keep-alive and stalled clients release their thread
+    assets: AssetCache = None
+
+    def do_GET(self):
+        self._serve(head=False)
+
+    def do_HEAD(self):
+        self._serve(head=True)
+
+    def do_OPTIONS(self):
+        self.send_response(204)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def end_headers(self):
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
+        self.send_header('Access-Control-Allow-Headers', '*')
+        super().end_headers()
+
+    def _serve(self, head: bool):
+        asset = self.assets.get(urlsplit(self.path).path)
+        if asset is None:
+            self.send_error(404, 'File not found')
+            return
+
+        encoding = 'identity'
+        accepted = _accepted_encodings(self.headers.get('Accept-Encoding', ''))
+        for candidate in ('br', 'gzip'):
+            if candidate in asset.variants and candidate in accepted:
+                encoding = candidate
+                break
+        body = asset.variants[encoding]
+        etag = asset.etags[encoding]
+
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match and (if_none_match.strip() == '*' or etag in [t.strip() for t in if_none_match.split(',')]):
+            self.send_response(304)
+            self._send_entity_headers(asset, etag, encoding)
+            self.end_headers()
+            return
+
+        status, start, end = 200, 0, len(body) - 1
+        range_header = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        # Ranges apply to the unencoded file only, and only while the client's copy is current
+        if range_header and encoding == 'identity' and (not if_range or if_range.strip() == etag):
+            byte_range = _parse_range(range_header, len(body))
+            if byte_range is False:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{len(body)}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            if byte_range:
+                status, (start, end) = 206, byte_range
+
+        self.send_response(status)
+        self._send_entity_headers(asset, etag, encoding)
+        self.send_header('Content-Type', asset.content_type)
+        self.send_header('Content-Length', str(end - start + 1))
+        if status == 206:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{len(body)}')
+        self.end_headers()
+        if not head:
+            self.wfile.write(memoryview(body)[start:end + 1])
+
+    def _send_entity_headers(self, asset: Asset, etag: str, encoding: str):
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', asset.last_modified)
+        self.send_header('Cache-Control', asset.cache_control)
+        self.send_header('Vary', 'Accept-Encoding')
+        self.send_header('Accept-Ranges', 'bytes')
+        if encoding != 'identity':
+            self.send_header('Content-Encoding', encoding)
+
+    def log_message(self, format, *args):
+        logger.info(f"{self.address_string()} {format % args}")
+
+
+class StaticServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self, address, handler, ssl_context: ssl.SSLContext = None):
+        self.ssl_context = ssl_context
+        super().__init__(address, handler)
+
+    def finish_request(self, request, client_address):
+        if self.ssl_context is None:
+            return super().finish_request(request, client_address)
+        # Handshake in the connection's own thread so a slow client cannot stall accept()
+        request.settimeout(StaticHandler.timeout)
+        tls_request = self.ssl_context.wrap_socket(request, server_side=True)
+        try:
+            super().finish_request(tls_request, client_address)
+        finally:
+            tls_request.close()
+
+    def handle_error(self, request, client_address):
+        logger.debug(f"Connection error from {client_address}", exc_info=True)
+
+
+def serve(port: int, root: str = None, certfile: str = None, keyfile: str = None):
+    root = root or os.path.dirname(os.path.abspath(__file__))
+    handler = type('Handler', (StaticHandler,), {'assets': AssetCache(root)})
+    handler.assets.warm()
+
+    ssl_context = None
+    if certfile:
+        ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        ssl_context.load_cert_chain(os.path.join(root, certfile), os.path.join(root, keyfile))
+
+    httpd = StaticServer(('0.0.0.0', port), handler, ssl_context)
+    try:
+        httpd.serve_forever()
+    finally:
+        httpd.server_close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serve the LiveKit demo assets")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--tls", action="store_true", help="serve HTTPS with cert.pem/key.pem")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    serve(args.port, certfile='cert.pem' if args.tls else None, keyfile='key.pem' if args.tls else None)
@@ -0,0 +1,183 @@
+import asyncio
+import hmac
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable
+
+from dotenv import load_dotenv
+from fastapi import APIRouter, FastAPI, HTTPException, Request
+from fastapi.responses import Response
+from telegram import Bot, Update
+
+from bot import ArabicVoiceBot, build_application
+from resilience import retry_with_backoff
+from tracing import admin_router
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateDispatcher:
+    """Bounded worker pool: updates run concurrently across chats but in order within a chat."""
+
+    def __init__(self, handle: Callable[[Update], Awaitable], lanes: int = 32, lane_size: int = 64):
+        self.handle = handle
+        self._queues = [asyncio.Queue(maxsize=lane_size) for _ in range(lanes)]
+        self._workers = []
+        # chat -> (oldest rejected update_id, when); newer updates wait until Telegram redelivers it
+        self._held = {}
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(q.qsize() for q in self._queues)
+
+    def start(self):
+        self._workers = [asyncio.create_task(self._work(q)) for q in self._queues]
+
+    async def stop(self, drain_timeout: float = 30.0):
+        # Finish what was already accepted so a restart does not drop acknowledged updates
+        try:
+            await asyncio.wait_for(asyncio.gather(*(q.join() for q in self._queues)), drain_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Stopping with {self.queue_depth} updates still queued")
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+
+    def submit(self, chat_key: int, update: Update, hold_seconds: float = 300.0) -> bool:
+        # The same chat always maps to the same lane, which preserves its ordering
+        now = time.monotonic()
+        for key in [key for key, (_, since) in self._held.items() if now - since >= hold_seconds]:
+            # Telegram gave up redelivering; stop holding the chat
+            del self._held[key]
+        held = self._held.get(chat_key)
+        if held is not None and update.update_id > held[0]:
+            # Accepting this before the rejected update comes back would reorder the chat
+            return False
+        try:
+            self._queues[hash(chat_key) % len(self._queues)].put_nowait(update)
+        except asyncio.QueueFull:
+            if held is None or update.update_id < held[0]:
+                self._held[chat_key] = (update.update_id, now)
+            return False
+        if held is not None and update.update_id >= held[0]:
+            del self._held[chat_key]
+        return True
+
+    async def _work(self, queue: asyncio.Queue):
+        while True:
+            update = await queue.get()
+            try:
+                await self.handle(update)
+            except Exception as e:
+                logger.error(f"Error processing update {update.update_id}: {e}")
+            finally:
+                queue.task_done()
+
+
+class TelegramWebhook:
+    def __init__(self, bot: ArabicVoiceBot = None):
+        self.bot = bot or ArabicVoiceBot()
+        self.application = build_application(self.bot, webhook=True)
+        self.secret = os.getenv('TELEGRAM_WEBHOOK_SECRET')
+        self.dispatcher = UpdateDispatcher(
+            self.application.process_update,
+            lanes=int(os.getenv('WEBHOOK_CONCURRENCY', '32')),
+            lane_size=int(os.getenv('WEBHOOK_LANE_SIZE', '64')),
+        )
+        self._warmup_task = None
+        self._start_task = None
+        self.started = False
+        self.router = APIRouter()
+        self.router.add_api_route("/telegram/webhook", self.receive, methods=["POST"])
+
+    async def start(self):
+        # Telegram being unreachable must not block or crash the host server's startup;
+        # updates received meanwhile wait in the lanes
+        self._start_task = asyncio.create_task(self._start())
+
+    async def _start(self):
+        await retry_with_backoff(self.application.initialize, "Initializing Telegram application")
+        await self.application.start()
+        self.dispatcher.start()
+        self.started = True
+        self._warmup_task = asyncio.create_task(self.bot.warmup())
+
+    async def stop(self):
+        if self._start_task and not self._start_task.done():
+            self._start_task.cancel()
+        if not self.started:
+            return
+        await self.dispatcher.stop()
+        if self._warmup_task:
+            self._warmup_task.cancel()
+        await self.application.stop()
+        await self.application.shutdown()
+
+    async def receive(self, request: Request):
+        if self.secret and not hmac.compare_digest(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), self.secret):
+            raise HTTPException(status_code=403, detail="Invalid webhook secret")
+        update = Update.de_json(await request.json(), self.application.bot)
+        chat = update.effective_chat
+        if not self.dispatcher.submit(chat.id if chat else update.update_id, update):
+            # Telegram redelivers on non-2xx responses, so shed rather than queue without bound
+            logger.warning(f"Webhook queue full ({self.dispatcher.queue_depth}), asking Telegram to retry")
+            return Response(status_code=503)
+        return Response(status_code=200)
+
+
+async def register_webhook():
+    """Point Telegram at our webhook URL; run once per deploy, not once per worker process."""
+    url = os.getenv('TELEGRAM_WEBHOOK_URL')
+    if not url:
+        raise SystemExit("TELEGRAM_WEBHOOK_URL is not set")
+    async with Bot(os.getenv('TELEGRAM_BOT_TOKEN')) as bot:
+        await bot.set_webhook(
+            url=url,
+            secret_token=os.getenv('TELEGRAM_WEBHOOK_SECRET'),
+            max_connections=100,
+            allowed_updates=Update.ALL_TYPES,
+        )
+    logger.info(f"Telegram webhook set to {url}")
+
+
+def create_app() -> FastAPI:
+    webhook = TelegramWebhook()
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        await webhook.start()
+        yield
+        await webhook.stop()
+
+    app = FastAPI(title="Alrah AI Telegram Webhook", lifespan=lifespan)
+    app.include_router(webhook.router)
+    app.include_router(admin_router(webhook.bot.tracer))
+
+    @app.get("/health")
+    async def health():
+        return {
+            "status": "ok",
+            "ready": webhook.started and webhook.bot.index is not None,
+            "queue_depth": webhook.dispatcher.queue_depth,
+        }
+
+    return app
+
+
+def serve():
+    import uvicorn
+    # Lanes only order a chat within one process; Telegram spreads deliveries across processes,
+    # so more than one worker gives up per-chat ordering
+    uvicorn.run(
+        "telegram_webhook:create_app",
+        factory=True,
+        host="0.0.0.0",
+        port=int(os.getenv('WEBHOOK_PORT', '8081')),
+        workers=int(os.getenv('WEBHOOK_WORKERS', '1')),
+        timeout_keep_alive=30
+    )
@@ -0,0 +1,288 @@
+import contextvars
+import hmac
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, deque
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Caller-supplied IDs end up in logs and response headers, so anything else gets a fresh ID
+_TRACE_ID = re.compile(r"[A-Za-z0-9_-]{1,64}")
+
+# The active request's trace; asyncio tasks and coalesced calls inherit it from their creator
+_current: contextvars.ContextVar = contextvars.ContextVar("trace", default=None)
+
+
+class Trace:
+    def __init__(self, name: str, trace_id: str = None, **attrs):
+        self.name = name
+        self.trace_id = trace_id if trace_id and _TRACE_ID.fullmatch(trace_id) else uuid.uuid4().hex[:16]
+        self.attrs = attrs
+        self.stages: List[Dict] = []
+        self.started_at = time.time()
+        self.started = time.monotonic()
+        self.duration: Optional[float] = None
+        self.error: Optional[str] = None
+
+    def to_dict(self) -> Dict:
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "started_at": round(self.started_at, 3),
+            "duration": round(self.duration if self.duration is not None else time.monotonic() - self.started, 4),
+            "error": self.error,
+            "attrs": self.attrs,
+            "stages": self.stages,
+        }
+
+
+def current_trace_id() -> Optional[str]:
+    trace = _current.get()
+    return trace.trace_id if trace else None
+
+
+class TraceIdFilter(logging.Filter):
+    """Stamps the current request's trace ID onto log records as %(trace_id)s."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.trace_id = current_trace_id() or "-"
+        return True
+
+
+def install_log_context(fmt: str = "%(levelname)s:%(name)s:[%(trace_id)s] %(message)s"):
+    """Add trace IDs to every line written by the root logger's handlers."""
+    for handler in logging.getLogger().handlers:
+        if not any(isinstance(f, TraceIdFilter) for f in handler.filters):
+            handler.addFilter(TraceIdFilter())
+            handler.setFormatter(logging.Formatter(fmt))
+
+
+def annotate(**attrs):
+    """Attach attributes (cache hits, sizes, queue waits) to the current trace, if any."""
+    trace = _current.get()
+    if trace is not None:
+        trace.attrs.update(attrs)
+
+
+@contextmanager
+def stage(name: str, **attrs):
+    """Time one stage of the current request; a no-op outside a traced request."""
+    trace = _current.get()
+    if trace is None:
+        yield
+        return
+    start = time.monotonic()
+    record = {"stage": name, "start": round(start - trace.started, 4), **attrs}
+    try:
+        yield
+    except BaseException as e:
+        record["error"] = repr(e)
+        raise
+    finally:
+        record["duration"] = round(time.monotonic() - start, 4)
+        trace.stages.append(record)
+
+
+class Tracer:
+    """Starts request traces and keeps the ones slower than a threshold."""
+
+    def __init__(self, slow_threshold: float = 5.0, log_path: str = None, keep: int = 100):
+        self.slow_threshold = slow_threshold
+        self.log_path = log_path
+        self.recent = deque(maxlen=keep)
+        self.slow = 0
+        self._lock = threading.Lock()
+        if log_path:
+            os.makedirs(os.path.dirname(log_path) or ".", exist_ok=True)
+
+    @contextmanager
+    def request(self, name: str, trace_id: str = None, **attrs):
+        trace = Trace(name, trace_id, **attrs)
+        token = _current.set(trace)
+        try:
+            yield trace
+        except BaseException as e:
+            trace.error = repr(e)
+            raise
+        finally:
+            _current.reset(token)
+            trace.duration = time.monotonic() - trace.started
+            if trace.duration >= self.slow_threshold:
+                self._record_slow(trace)
+
+    def _record_slow(self, trace: Trace):
+        record = trace.to_dict()
+        breakdown = ", ".join(f"{s['stage']}={s['duration']:.2f}s" for s in trace.stages)
+        logger.warning(f"Slow request {trace.trace_id} {trace.name} took {trace.duration:.2f}s: {breakdown}")
+        with self._lock:
+            self.slow += 1
+            self.recent.append(record)
+            if self.log_path:
+                # One short append per line, so several worker processes can share the file
+                with open(self.log_path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def slow_requests(self, limit: int = 20) -> List[Dict]:
+        with self._lock:
+            return list(self.recent)[-limit:][::-1]
+
+
+def tracer_from_env() -> Tracer:
+    return Tracer(
+        slow_threshold=float(os.getenv('SLOW_REQUEST_SECONDS', '5')),
+        log_path=os.getenv('SLOW_REQUEST_LOG', 'logs/slow_requests.jsonl'),
+    )
+
+
+# Leaf frames of threads that are just waiting for work
+_IDLE_FRAMES = {
+    ("threading.py", "wait"), ("selectors.py", "select"), ("queue.py", "get"),
+    ("threading.py", "_wait_for_tstate_lock"), ("thread.py", "_worker"), ("socket.py", "accept"),
+    ("base_events.py", "_run_once"),
+}
+
+
+class SamplingProfiler:
+    """Samples every thread's Python stack on a timer thread.
+
+    Costs one stack walk per thread per interval, so it can be switched on in production
+    for a few minutes; nothing runs while it is stopped."""
+
+    def __init__(self, max_depth: int = 48):
+        self.max_depth = max_depth
+        self.interval = 0.01
+        self.stacks = Counter()
+        self.samples = 0
+        self.started_at = None
+        self.stopped_at = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._data_lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, interval: float = 0.01):
+        with self._lock:
+            if self.running:
+                return
+            self.interval = max(0.001, interval)
+            self.stacks = Counter()
+            self.samples = 0
+            self.started_at = time.time()
+            self.stopped_at = None
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+            self._thread.start()
+        logger.info(f"Sampling profiler started ({self.interval * 1000:.0f}ms interval)")
+
+    def stop(self):
+        with self._lock:
+            if not self.running:
+                return
+            self._stop.set()
+            self._thread.join()
+            self.stopped_at = time.time()
+        logger.info(f"Sampling profiler stopped after {self.samples} samples")
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            sample = []
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    code = frame.f_code
+                    stack.append((os.path.basename(code.co_filename), code.co_name))
+                    frame = frame.f_back
+                if not stack or stack[0] in _IDLE_FRAMES:
+                    continue
+                sample.append(";".join(f"{f}:{n}" for f, n in reversed(stack)))
+            with self._data_lock:
+                self.stacks.update(sample)
+                self.samples += 1
+
+    def folded(self) -> str:
+        """Stacks in the collapsed format read by flamegraph.pl and speedscope."""
+        with self._data_lock:
+            stacks = self.stacks.copy()
+        return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+    def report(self, top: int = 25) -> Dict:
+        with self._data_lock:
+            stacks = self.stacks.copy()
+        total = sum(stacks.values())
+        self_counts = Counter()
+        inclusive_counts = Counter()
+        for stack, count in stacks.items():
+            frames = stack.split(";")
+            self_counts[frames[-1]] += count
+            for frame in set(frames):
+                inclusive_counts[frame] += count
+
+        def share(counter):
+            return [{"frame": frame, "samples": count, "percent": round(100.0 * count / total, 1)}
+                    for frame, count in counter.most_common(top)]
+
+        return {
+            "running": self.running,
+            "interval": self.interval,
+            "samples": self.samples,
+            "busy_samples": total,
+            "duration": round((self.stopped_at or time.time()) - self.started_at, 1) if self.started_at else 0,
+            "self": share(self_counts) if total else [],
+            "inclusive": share(inclusive_counts) if total else [],
+        }
+
+
+# One profiler per process: it samples every thread regardless of which app started it
+profiler = SamplingProfiler()
+
+
+def admin_router(tracer: Tracer):
+    """Admin endpoints for slow requests and the profiler, enabled only when ADMIN_TOKEN is set."""
+    from fastapi import APIRouter, Depends, HTTPException, Request
+    from fastapi.responses import PlainTextResponse
+
+    async def require_admin(request: Request):
+        token = os.getenv('ADMIN_TOKEN')
+        if not token or not hmac.compare_digest(request.headers.get("X-Admin-Token", ""), token):
+            raise HTTPException(status_code=403, detail="Forbidden")
+
+    router = APIRouter(prefix="/admin", dependencies=[Depends(require_admin)])
+
+    @router.get("/slow-requests")
+    async def slow_requests(limit: int = 20):
+        return {"threshold": tracer.slow_threshold, "total": tracer.slow, "requests": tracer.slow_requests(limit)}
+
+    @router.post("/profiler/start")
+    async def start_profiler(interval_ms: float = 10):
+        profiler.start(interval_ms / 1000)
+        return profiler.report(top=0)
+
+    @router.post("/profiler/stop")
+    async def stop_profiler(top: int = 25):
+        profiler.stop()
+        return profiler.report(top)
+
+    @router.get("/profiler")
+    async def profiler_report(top: int = 25):
+        return profiler.report(top)
+
+    @router.get("/profiler/folded", response_class=PlainTextResponse)
+    async def profiler_folded():
+        return profiler.folded()
+
+    return router